@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# end-to-end benchmark of "efly dd". builds a local repository of synthetic packages (see fakerepo.py),
+# serves it over http on localhost and runs the complete efly-dd flow with the "bench" profile against
+# a sparse image file: partitioning, loop device, mkfs, pacstrap, extra files, grub and postinst.
+# no network access is needed. on hosts other than arch linux, efly-dd needs the archlinux bootstrap
+# tarball. it is taken from the efly cache, if it was downloaded before.
+#
+# records the duration of each phase (efly-dd --timings), the bytes written to the image and the peak
+# memory usage. results are printed as json. compare result files with --compare.
+#
+# with --io, the root filesystem of each built image is mounted with the options of its fstab and
+# benchmarked: small files, sequential and random i/o, and the bytes that reached the device per
+# byte written by the workload. together with --rootfs this compares the root filesystem backends.
+#
+# requires sudo, like efly-dd itself.
+
+import argparse, json, os, platform, random, resource, shutil, statistics, subprocess, sys, tempfile, threading, time
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+
+import fakerepo
+
+repo_dir = Path(__file__).resolve().parent.parent
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve(directory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=str(directory)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def git_commit(path):
+    try:
+        return subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# separate cache for the benchmark, so that the bootstrap system of real builds is not touched.
+# a bootstrap tarball of the regular efly cache is reused to avoid downloading it.
+def prepare_cache(cache_home):
+    user_cache = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "efly" / "dd"
+    bench_cache = Path(cache_home) / "efly" / "dd"
+    bench_cache.mkdir(parents=True, exist_ok=True)
+    tarballs = list(user_cache.glob("archlinux-bootstrap-*-x86_64.tar.zst"))
+    for tarball in tarballs:
+        link = bench_cache / tarball.name
+        if not link.exists():
+            link.symlink_to(tarball)
+    if not Path("/etc/arch-release").exists() and not tarballs:
+        print("[bench] warning: no bootstrap tarball in the efly cache. efly-dd will try to download it.", file=sys.stderr)
+
+def run_once(options, workdir, conf, cache_home, index):
+    image = workdir / f"bench-{index}.img"
+    timings = workdir / f"timings-{index}.json"
+    image.unlink(missing_ok=True)
+    os.truncate(image, options.image_size)
+
+    cmd = [options.efly_dd, "--nocolor", "--profile", options.profile, "--pacman-conf", conf, "--timings", timings,
+        "--rootfs", options.rootfs, image]
+    env = dict(os.environ, XDG_CACHE_HOME=str(cache_home))
+    log = open(workdir / f"efly-dd-{index}.log", "w")
+    start = time.perf_counter()
+    returncode = subprocess.run(cmd, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    elapsed = time.perf_counter() - start
+    log.close()
+    if returncode != 0:
+        tail = (workdir / f"efly-dd-{index}.log").read_text(errors="replace").splitlines()[-20:]
+        print("\n".join(["[bench] efly-dd failed:"] + tail), file=sys.stderr)
+
+    result = {
+        "returncode": returncode,
+        "wall_seconds": elapsed,
+        # the image is sparse. allocated blocks are the bytes that efly-dd actually wrote.
+        "image_bytes_written": image.stat().st_blocks * 512,
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "log": str(workdir / f"efly-dd-{index}.log"),
+    }
+    if timings.is_file():
+        result.update(json.loads(timings.read_text()))
+    if options.io and returncode == 0:
+        result["io"] = io_bench(image, workdir)
+    if not options.keep_image:
+        image.unlink()
+    return result
+
+# mount the root partition of an image like the image itself does and run io_test() on it as root
+def io_bench(image, workdir):
+    mountpoint = workdir / "io-mnt"
+    mountpoint.mkdir(exist_ok=True)
+    loop = subprocess.check_output(["sudo", "losetup", "--show", "--find", "--partscan", image]).decode().strip()
+    root = f"{loop}p2"
+    try:
+        subprocess.run(["sudo", "mount", "--read-only", root, mountpoint], check=True)
+        try:
+            fstab = (mountpoint / "etc" / "fstab").read_text()
+        finally:
+            subprocess.run(["sudo", "umount", mountpoint], check=True)
+        fstype, mount_options = next(line.split()[2:4] for line in fstab.splitlines() if line.split()[1:2] == ["/"])
+
+        subprocess.run(["sudo", "mount", "--options", mount_options, root, mountpoint], check=True)
+        try:
+            output = subprocess.check_output(["sudo", sys.executable, __file__, "--io-test", mountpoint, "--io-device", Path(root).name])
+        finally:
+            subprocess.run(["sudo", "umount", mountpoint], check=True)
+    finally:
+        subprocess.run(["sudo", "losetup", "--detach", loop])
+    result = json.loads(output)
+    result.update({"fstype": fstype, "mount_options": mount_options})
+    return result
+
+# i/o workload on a mounted filesystem. runs as root to drop the page cache between the steps.
+# half of each 4KiB block is random, so that compressing filesystems save about half of the writes.
+def io_test(path, device, small_files=2000, large_size=256 * 1024 * 1024, random_reads=4000):
+    rng = random.Random(0)
+    block = lambda: rng.randbytes(2048) + bytes(2048)
+    chunk = b"".join(block() for _ in range(256))
+    stat = Path("/sys/class/block") / device / "stat"
+    sectors_written = lambda: int(stat.read_text().split()[6])
+    def drop_caches():
+        os.sync()
+        Path("/proc/sys/vm/drop_caches").write_text("3")
+
+    test_dir = Path(path) / "efly-io-bench"
+    test_dir.mkdir()
+    large = test_dir / "large"
+    result = {}
+    try:
+        drop_caches()
+        written = sectors_written()
+        start = time.perf_counter()
+        data = block()
+        for i in range(small_files):
+            (test_dir / f"small-{i:05d}").write_bytes(data)
+        os.sync()
+        result["small_files_per_second"] = small_files / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with open(large, "wb") as f:
+            for _ in range(large_size // len(chunk)):
+                f.write(chunk)
+            os.fsync(f.fileno())
+        result["sequential_write_mib_per_second"] = large_size / 1024**2 / (time.perf_counter() - start)
+        os.sync()
+        result["device_bytes_written"] = (sectors_written() - written) * 512
+        result["write_amplification"] = result["device_bytes_written"] / (small_files * len(data) + large_size)
+
+        drop_caches()
+        start = time.perf_counter()
+        with open(large, "rb") as f:
+            while f.read(len(chunk)):
+                pass
+        result["sequential_read_mib_per_second"] = large_size / 1024**2 / (time.perf_counter() - start)
+
+        drop_caches()
+        fd = os.open(large, os.O_RDONLY)
+        try:
+            start = time.perf_counter()
+            for _ in range(random_reads):
+                os.pread(fd, 4096, rng.randrange(large_size // 4096) * 4096)
+            result["random_reads_per_second"] = random_reads / (time.perf_counter() - start)
+        finally:
+            os.close(fd)
+    finally:
+        shutil.rmtree(test_dir)
+    return result
+
+def summarize(runs):
+    ok = [r for r in runs if r["returncode"] == 0]
+    if not ok:
+        return {}
+    summary = {
+        "wall_seconds": statistics.median(r["wall_seconds"] for r in ok),
+        "image_bytes_written": statistics.median(r["image_bytes_written"] for r in ok),
+        "peak_rss_kib": max(r["peak_rss_kib"] for r in ok),
+        "phases": {},
+    }
+    names = [p["name"] for p in ok[0].get("phases", [])]
+    for name in names:
+        times = [p["seconds"] for r in ok for p in r.get("phases", []) if p["name"] == name]
+        summary["phases"][name] = statistics.median(times)
+    io = [r["io"] for r in ok if "io" in r]
+    if io:
+        summary["io"] = {k: statistics.median(i[k] for i in io) for k in io[0] if isinstance(io[0][k], (int, float))}
+    return summary
+
+# print result files side by side, phase by phase. the change is relative to the first file.
+def compare(files):
+    results = [json.loads(Path(f).read_text()) for f in files]
+    summaries = [r.get("summary", {}) for r in results]
+    labels = [r.get("options", {}).get("rootfs", "ext4") for r in results]
+    if len(set(labels)) < len(labels):
+        labels = ["base", "new"] if len(results) == 2 else [Path(f).stem for f in files]
+    for label, result in zip(labels, results):
+        print(f"{label}: {result.get('commit')}")
+    print(f"{'':32s}" + "".join(f" {label[:10]:>10s} {'change' if i else '':>8s}" for i, label in enumerate(labels)))
+
+    keys = lambda section: dict.fromkeys(k for s in summaries for k in s.get(section, {}))
+    rows = [(f"phase {n}", [s.get("phases", {}).get(n) for s in summaries]) for n in keys("phases")]
+    rows += [(k, [s.get(k) for s in summaries]) for k in ["wall_seconds", "image_bytes_written", "peak_rss_kib"]]
+    rows += [(f"io {k}", [s.get("io", {}).get(k) for s in summaries]) for k in keys("io")]
+    fmt = lambda v: "-" if v is None else f"{v:.2f}" if isinstance(v, float) else str(v)
+    for name, values in rows:
+        line = f"{name:32s}"
+        for i, value in enumerate(values):
+            change = f"{(value - values[0]) / values[0] * 100:+.1f}%" if i and values[0] and value is not None else ""
+            line += f" {fmt(value):>10s} {change:>8s}"
+        print(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of efly dd against a local repository of synthetic packages. Prints JSON.")
+    parser.add_argument("--runs", type=int, default=1, help="Number of builds.")
+    parser.add_argument("--image-size", type=int, default=4 * 1024**3, help="Size of the sparse image file in bytes.")
+    parser.add_argument("--payload-size", type=int, default=64 * 1024**2, help="Total size of the synthetic package data in bytes.")
+    parser.add_argument("--payload-files", type=int, default=2000, help="Number of files of the synthetic package data.")
+    parser.add_argument("--kernel-size", type=int, default=24 * 1024**2, help="Size of kernel and initramfs in /boot in bytes.")
+    parser.add_argument("--profile", default="bench", help="Profile to build. Its packages must exist in the synthetic repository.")
+    parser.add_argument("--rootfs", default="ext4", help="Root filesystem of the image: ext4, btrfs or f2fs. Default: %(default)s")
+    parser.add_argument("--io", action="store_true", help="Benchmark the i/o of the root filesystem of each built image.")
+    parser.add_argument("--efly-dd", default=str(repo_dir / "efly" / "efly-dd"),
+        help="efly-dd to run, e.g. from a git worktree of another commit. Default: %(default)s")
+    parser.add_argument("--workdir", help="Keep repository, logs and images in this folder instead of a temporary one.")
+    parser.add_argument("--keep-image", action="store_true", help="Do not delete the image files after the build.")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="Compare two or more result files and exit.")
+    parser.add_argument("--io-test", help=argparse.SUPPRESS)
+    parser.add_argument("--io-device", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    if options.compare:
+        compare(options.compare)
+        return
+    if options.io_test:
+        print(json.dumps(io_test(options.io_test, options.io_device)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="efly-bench__") as tmp:
+        workdir = Path(options.workdir or tmp).resolve()
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        start = time.perf_counter()
+        repo = fakerepo.build_repo(workdir / "repo", options.payload_size, options.payload_files, options.kernel_size)
+        repo_seconds = time.perf_counter() - start
+
+        server = serve(repo)
+        url = f"http://127.0.0.1:{server.server_address[1]}/"
+        conf = workdir / "pacman.conf"
+        conf.write_text(fakerepo.pacman_conf(url, workdir / "pkgcache"))
+
+        cache_home = Path.home() / ".cache" / "efly-bench"
+        prepare_cache(cache_home)
+
+        runs = []
+        try:
+            for i in range(options.runs):
+                runs.append(run_once(options, workdir, conf, cache_home, i))
+                print(f"[bench] run {i}: {runs[-1]['wall_seconds']:.1f}s, returncode {runs[-1]['returncode']}", file=sys.stderr)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        results = {
+            "benchmark": "dd",
+            "commit": git_commit(Path(options.efly_dd).resolve().parent),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "host": platform.node(),
+            "kernel": platform.release(),
+            "options": {k: v for k, v in vars(options).items() if k not in ("compare", "output", "io_test", "io_device")},
+            "repo_build_seconds": repo_seconds,
+            "runs": runs,
+            "summary": summarize(runs),
+        }
+
+    output = json.dumps(results, indent=2, default=str)
+    if options.output:
+        Path(options.output).write_text(output + "\n")
+    else:
+        print(output)
+    if any(r["returncode"] != 0 for r in runs):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
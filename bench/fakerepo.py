@@ -0,0 +1,170 @@
+# builds a local pacman repository of synthetic packages, so that "efly dd" can be benchmarked
+# without network access. the packages mimic the size and file count of a real installation, but
+# only contain random data and a few shell script shims for the commands that efly-dd runs inside
+# the chroot (grub-install, locale-gen, pacman). a shell and "mkdir" are copied from the host.
+#
+# repository layout: <repo>/<name>/os/x86_64/{<name>.db, <pkg>.pkg.tar.gz, ...}
+
+import hashlib, io, random, re, shutil, subprocess, tarfile, time
+from pathlib import Path
+
+arch = "x86_64"
+pkgver = "0.1-1"
+packager = "efly bench <bench@efly.invalid>"
+
+shims = {
+    "usr/bin/locale-gen": "#!/bin/sh\necho \"[bench] locale-gen: nothing to do\"\n",
+    "usr/bin/pacman": "#!/bin/sh\necho \"[bench] pacman $*: nothing to do\"\n",
+    "usr/bin/grub-install": (
+        "#!/bin/sh\n"
+        "mkdir -p /boot/grub /boot/EFI/BOOT\n"
+        "echo \"efly bench bootloader\" > /boot/EFI/BOOT/BOOTX64.EFI\n"
+    ),
+}
+
+# return the host file and the shared libraries it needs
+def host_binary(path):
+    files = [Path(path)]
+    try:
+        output = subprocess.check_output(["ldd", path], stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return files # static binary
+    for match in re.finditer(r'(/\S+) \(0x', output):
+        files.append(Path(match[1]))
+    return files
+
+# files for the "bench-base" package: shell, mkdir and shims. busybox is used, if available.
+def base_files():
+    files = {}
+    busybox = shutil.which("busybox")
+    for tool in ["sh", "mkdir"]:
+        binary = busybox or shutil.which(tool)
+        if not binary:
+            raise RuntimeError(f"command not found on host: {tool}")
+        host_files = host_binary(binary)
+        data = host_files[0].read_bytes()
+        files[f"usr/bin/{tool}"] = (data, 0o755)
+        if tool == "sh":
+            files["bin/sh"] = (data, 0o755)
+        for lib in host_files[1:]:
+            files[str(lib).lstrip("/")] = (lib.read_bytes(), 0o755)
+    for path, script in shims.items():
+        files[path] = (script.encode(), 0o755)
+    files["etc/os-release"] = (b'NAME="efly bench"\nID=arch\n', 0o644)
+    files["etc/resolv.conf"] = (b"", 0o644)
+    return files
+
+def random_files(prefix, count, size, rng):
+    files = {}
+    if count == 0:
+        return files
+    each = max(1, size // count)
+    for i in range(count):
+        files[f"{prefix}/{i // 100:03d}/file{i:05d}"] = (rng.randbytes(each), 0o644)
+    return files
+
+# write a package and return its db entry
+def write_package(repo_dir, name, files, depends=(), desc=""):
+    filename = f"{name}-{pkgver}-{arch}.pkg.tar.gz"
+    builddate = int(time.time())
+    isize = sum(len(data) for data, _ in files.values())
+    pkginfo = "".join(f"{k} = {v}\n" for k, v in [
+        ("pkgname", name), ("pkgbase", name), ("pkgver", pkgver), ("pkgdesc", desc or name),
+        ("builddate", builddate), ("packager", packager), ("size", isize), ("arch", arch),
+    ] + [("depend", d) for d in depends])
+
+    def add(tar, path, data=None, mode=0o644):
+        info = tarfile.TarInfo(path)
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        info.mtime = builddate
+        if data is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+        else:
+            info.size = len(data)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(data))
+
+    with tarfile.open(repo_dir / filename, "w:gz", compresslevel=1) as tar:
+        add(tar, ".PKGINFO", pkginfo.encode())
+        dirs = sorted({str(p) for path in files for p in Path(path).parents if str(p) != "."})
+        for d in dirs:
+            add(tar, d)
+        for path, (data, mode) in sorted(files.items()):
+            add(tar, path, data, mode)
+
+    package = repo_dir / filename
+    desc_fields = [
+        ("FILENAME", filename), ("NAME", name), ("BASE", name), ("VERSION", pkgver), ("DESC", desc or name),
+        ("CSIZE", package.stat().st_size), ("ISIZE", isize),
+        ("SHA256SUM", hashlib.sha256(package.read_bytes()).hexdigest()),
+        ("ARCH", arch), ("BUILDDATE", builddate), ("PACKAGER", packager),
+    ]
+    if depends:
+        desc_fields.append(("DEPENDS", "\n".join(depends)))
+    return f"{name}-{pkgver}", "".join(f"%{k}%\n{v}\n\n" for k, v in desc_fields)
+
+def write_db(repo_dir, repo, entries):
+    db = repo_dir / f"{repo}.db.tar.gz"
+    with tarfile.open(db, "w:gz") as tar:
+        for dirname, desc in entries:
+            info = tarfile.TarInfo(dirname)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            data = desc.encode()
+            info = tarfile.TarInfo(f"{dirname}/desc")
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    link = repo_dir / f"{repo}.db"
+    link.unlink(missing_ok=True)
+    link.symlink_to(db.name)
+
+# build the repository "core" with the packages of the "bench" profile. returns the repository root.
+def build_repo(root, payload_size=64 * 1024 * 1024, payload_files=2000, kernel_size=24 * 1024 * 1024, seed=0):
+    root = Path(root)
+    repo_dir = root / "core" / "os" / arch
+    repo_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    kernel = {
+        "boot/vmlinuz-linux": (rng.randbytes(kernel_size // 3), 0o644),
+        "boot/initramfs-linux.img": (rng.randbytes(kernel_size - kernel_size // 3), 0o644),
+    }
+    kernel.update(random_files("usr/lib/modules/bench", payload_files // 4, payload_size // 4, rng))
+
+    grub = {"usr/lib/grub/x86_64-efi/grub.efi": (rng.randbytes(2 * 1024 * 1024), 0o644)}
+
+    # on hosts other than arch linux, efly-dd updates the arch bootstrap system from this repository and
+    # allows downgrades. packages of the bootstrap system with the same name are replaced. "base" is only
+    # a meta package there, so the synthetic one is empty as well. the files of the base system are in
+    # "bench-base", which does not exist in arch linux and is installed by the bench profile.
+    entries = [
+        write_package(repo_dir, "base", {}, desc="empty base meta package"),
+        write_package(repo_dir, "bench-base", base_files(), desc="minimal base system with a shell from the host"),
+        write_package(repo_dir, "linux", kernel, depends=["bench-base"], desc="synthetic kernel"),
+        write_package(repo_dir, "grub", grub, depends=["bench-base"], desc="synthetic boot loader"),
+        write_package(repo_dir, "bench-data",
+            random_files("usr/share/bench-data", payload_files - payload_files // 4, payload_size - payload_size // 4, rng),
+            depends=["bench-base"], desc="synthetic payload"),
+        # installed by "efly dd --rootfs btrfs|f2fs" for the filesystem tools of the image
+        write_package(repo_dir, "btrfs-progs", {}, depends=["bench-base"], desc="synthetic btrfs tools"),
+        write_package(repo_dir, "f2fs-tools", {}, depends=["bench-base"], desc="synthetic f2fs tools"),
+    ]
+    write_db(repo_dir, "core", entries)
+    return root
+
+# pacman.conf that installs from the repository served at the given url
+def pacman_conf(url, cache_dir):
+    return (
+        "[options]\n"
+        "Architecture = auto\n"
+        "SigLevel = Never\n"
+        f"CacheDir = {cache_dir}/\n"
+        "\n"
+        "[core]\n"
+        f"Server = {url.rstrip('/')}/$repo/os/$arch\n"
+    )
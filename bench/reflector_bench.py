@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+# benchmarks for the vendored reflector module (efly/Reflector.py).
+#
+# processing: synthetic mirror status documents with 1k to 50k mirrors are parsed, indexed, filtered,
+# sorted and formatted into a mirror list.
+#
+# rating: a set of local http servers (and an rsync daemon, if rsync is installed) serve the repo
+# database with configurable bandwidth, latency and failure rate. rate() is timed in unthreaded and
+# threaded mode. since we know how fast each server is, we can also check how accurate the ranking is.
+#
+# all results are printed as json, so that they can be collected and compared across commits.
+
+import argparse, datetime, json, os, platform, random, shutil, socket, statistics, subprocess, sys, tempfile, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+repo_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_dir / "efly"))
+import Reflector
+
+countries = [
+    ("Germany", "DE"), ("United States", "US"), ("France", "FR"), ("Netherlands", "NL"),
+    ("Sweden", "SE"), ("Japan", "JP"), ("Brazil", "BR"), ("Australia", "AU"),
+    ("Canada", "CA"), ("India", "IN"), ("Kenya", "KE"), ("", ""),
+]
+protocols = ["https", "http", "rsync"]
+
+# ---- synthetic mirror status ---- #
+
+# generate a mirror status document in the format of https://archlinux.org/mirrors/status/json/
+def synthetic_status(n, seed=0):
+    rng = random.Random(seed)
+    now = time.time()
+    urls = []
+    for i in range(n):
+        country, code = rng.choice(countries)
+        protocol = rng.choice(protocols)
+        synced = rng.random() > 0.05
+        last_sync = time.strftime(Reflector.PARSE_TIME_FORMAT, time.gmtime(now - rng.uniform(0, 48) * 3600)) if synced else None
+        delay = int(rng.uniform(0, 24) * 3600) if synced else None
+        urls.append({
+            "url": f"{protocol}://mirror{i}.example.org/archlinux/",
+            "protocol": protocol,
+            "country": country,
+            "country_code": code,
+            "last_sync": last_sync,
+            "completion_pct": 1.0 if rng.random() > 0.1 else rng.random(),
+            "delay": delay,
+            "duration_avg": rng.uniform(0.1, 2.0) if synced else None,
+            "duration_stddev": rng.uniform(0, 0.5) if synced else None,
+            "score": rng.uniform(0.5, 20) if synced else None,
+            "active": True,
+            "isos": rng.random() > 0.3,
+            "ipv4": rng.random() > 0.02,
+            "ipv6": rng.random() > 0.4,
+            "details": f"https://archlinux.org/mirrors/mirror{i}.example.org/{i}/",
+        })
+    return {
+        "cutoff": 86400,
+        "last_check": datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime(Reflector.PARSE_TIME_FORMAT_WITH_USEC),
+        "num_checks": 24,
+        "check_frequency": 3600,
+        "urls": urls,
+        "version": 3,
+    }
+
+# run the given function several times. report the best and the median duration in seconds.
+def measure(func, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}, result
+
+# filter configurations roughly matching typical command lines
+filters = {
+    "default": {},
+    "https-age12": {"protocols": ["https"], "age": 12},
+    "countries": {"countries": ["DE", "France", "nl"], "protocols": ["https", "http"]},
+    "include-exclude": {"include": [r"mirror\d*7\."], "exclude": [r"mirror1"], "ipv6": True},
+}
+
+def bench_processing(sizes, repeat, workdir):
+    results = []
+    for n in sizes:
+        status = synthetic_status(n, seed=n)
+        status_file = workdir / f"status-{n}.json"
+        status_file.write_text(json.dumps(status))
+        url = status_file.as_uri()
+        entry = {"mirrors": n}
+
+        # cold: read through urlopen and write the cache. warm: read the cache.
+        entry["get_mirrorstatus_cold"], _ = measure(lambda: Reflector.get_mirrorstatus(cache_timeout=-1, url=url), repeat)
+        entry["get_mirrorstatus_warm"], (obj, _) = measure(lambda: Reflector.get_mirrorstatus(cache_timeout=3600, url=url), repeat)
+
+        # the index is cached next to the mirror status. measure compiling it and loading it.
+        index_path = Path(Reflector.get_cache_path(url) + ".index")
+        def build_index():
+            index_path.unlink(missing_ok=True)
+            return Reflector.get_mirror_index(obj, url=url)
+        entry["index_build"], index = measure(build_index, repeat)
+        entry["index_load"], _ = measure(lambda: Reflector.get_mirror_index(obj, url=url), repeat)
+
+        entry["filter"] = {}
+        for name, kwargs in filters.items():
+            msf = Reflector.MirrorStatusFilter(**kwargs)
+            entry["filter"][name], _ = measure(lambda: list(msf.filter_mirrors(index)), repeat)
+        entry["filter_unindexed"], _ = measure(lambda: list(Reflector.MirrorStatusFilter().filter_mirrors(obj["urls"])), repeat)
+
+        mirrors = list(index)
+        entry["sort"] = {}
+        entry["sort"]["age"], _ = measure(lambda: Reflector.sort(mirrors, by="age"), repeat)
+        entry["sort"]["score"], _ = measure(lambda: Reflector.sort(mirrors, by="score"), repeat)
+        key = Reflector.country_sort_key(["SE", "Germany", "*", "US"])
+        entry["sort"]["country"], _ = measure(lambda: Reflector.sort(mirrors, key=key), repeat)
+
+        entry["format_mirrorlist"], _ = measure(lambda: Reflector.format_mirrorlist(
+            {"last_check": obj["last_check"], "urls": mirrors}, time.time(), include_country=True), repeat)
+        results.append(entry)
+    return results
+
+# ---- rating harness ---- #
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "efly-bench"
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        if self.path != "/" + Reflector.DB_SUBPATH:
+            self.send_error(404)
+            return
+        failure = server.rng.random() < server.failure_rate
+        if failure and server.rng.random() < 0.5:
+            self.send_error(503)
+            return
+
+        data = server.payload
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+        # send in small pieces and sleep to keep the average rate at the configured bandwidth.
+        # a failing download is cut off after half of the data.
+        limit = len(data) // 2 if failure else len(data)
+        piece = max(1024, server.bandwidth // 50)
+        start = time.perf_counter()
+        sent = 0
+        try:
+            while sent < limit:
+                chunk = data[sent:min(sent + piece, limit)]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                ahead = sent / server.bandwidth - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except OSError:
+            pass
+        if failure:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(payload, bandwidth, latency, failure_rate, seed):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottledHandler)
+    server.daemon_threads = True
+    server.payload = payload
+    server.bandwidth = bandwidth
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.rng = random.Random(seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# rsync daemon serving the database under rsync://127.0.0.1:<port>/archlinux/. returns the process and the url.
+def start_rsync_daemon(workdir, payload, bandwidth):
+    root = workdir / "rsync"
+    db = root / Reflector.DB_SUBPATH
+    db.parent.mkdir(parents=True, exist_ok=True)
+    db.write_bytes(payload)
+    conf = workdir / "rsyncd.conf"
+    conf.write_text(f"use chroot = no\n[archlinux]\npath = {root}\nread only = yes\n")
+    port = free_port()
+    process = subprocess.Popen(
+        ["rsync", "--daemon", "--no-detach", f"--port={port}", f"--address=127.0.0.1", f"--config={conf}",
+            f"--bwlimit={max(1, bandwidth // 1024)}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process, f"rsync://127.0.0.1:{port}/archlinux/"
+
+def ranks(values):
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    result = [0.0] * len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            result[order[k]] = (i + j) / 2 # ties get the average rank
+        i = j + 1
+    return result
+
+def spearman(xs, ys):
+    rx, ry = ranks(xs), ranks(ys)
+    mx, my = statistics.mean(rx), statistics.mean(ry)
+    cov = sum((a - mx) * (b - my) for a, b in zip(rx, ry))
+    var = (sum((a - mx) ** 2 for a in rx) * sum((b - my) ** 2 for b in ry)) ** 0.5
+    return cov / var if var else 0.0
+
+def kendall(xs, ys):
+    concordant = discordant = 0
+    for i in range(len(xs)):
+        for j in range(i + 1, len(xs)):
+            s = (xs[i] - xs[j]) * (ys[i] - ys[j])
+            concordant += s > 0
+            discordant += s < 0
+    pairs = concordant + discordant
+    return (concordant - discordant) / pairs if pairs else 0.0
+
+def bench_rating(options, workdir):
+    rng = random.Random(options.seed)
+    payload = rng.randbytes(options.db_size)
+
+    # bandwidths are spread evenly on a log scale between the given limits, latencies are random.
+    servers = []
+    low, high = options.min_bandwidth, options.max_bandwidth
+    for i in range(options.servers):
+        bandwidth = int(low * (high / low) ** (i / max(1, options.servers - 1)))
+        latency = rng.uniform(0, options.max_latency)
+        server = start_http_server(payload, bandwidth, latency, options.failure_rate, options.seed + i)
+        host, port = server.server_address[:2]
+        servers.append({"url": f"http://{host}:{port}/", "protocol": "http", "bandwidth": bandwidth, "latency": latency, "server": server})
+
+    rsync = None
+    if shutil.which("rsync"):
+        rsync, url = start_rsync_daemon(workdir, payload, options.max_bandwidth)
+        servers.append({"url": url, "protocol": "rsync", "bandwidth": options.max_bandwidth, "latency": 0, "server": None})
+
+    results = {
+        "servers": [{k: v for k, v in s.items() if k != "server"} for s in servers],
+        "db_size": options.db_size,
+        "failure_rate": options.failure_rate,
+        "rsync": rsync is not None,
+        "runs": [],
+    }
+    mirrors = [{"url": s["url"]} for s in servers]
+    kwargs = {"connection_timeout": options.timeout, "download_timeout": options.timeout}
+    try:
+        for n_threads in [0] + options.threads:
+            start = time.perf_counter()
+            rates = Reflector.rate(mirrors, n_threads=n_threads, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            # the ground truth is the configured bandwidth, including the latency of the single request
+            truth = [options.db_size / (options.db_size / s["bandwidth"] + s["latency"]) for s in servers]
+            measured = [rates[s["url"]] for s in servers]
+            best = sorted(range(len(servers)), key=lambda i: truth[i], reverse=True)[:3]
+            best_measured = sorted(range(len(servers)), key=lambda i: measured[i], reverse=True)[:3]
+            results["runs"].append({
+                "n_threads": n_threads,
+                "seconds": elapsed,
+                "failed": sum(1 for r in measured if r == 0),
+                "spearman": spearman(truth, measured),
+                "kendall": kendall(truth, measured),
+                "top3_overlap": len(set(best) & set(best_measured)) / 3,
+                "rates": {s["url"]: r for s, r in zip(servers, measured)},
+            })
+    finally:
+        for s in servers:
+            if s["server"]:
+                s["server"].shutdown()
+                s["server"].server_close()
+        if rsync:
+            rsync.terminate()
+            rsync.wait()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "-C", repo_dir, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark filtering, sorting and rating of efly's reflector module. Prints JSON.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000, 50000], help="Mirror counts of the synthetic status documents.")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions of each processing benchmark.")
+    parser.add_argument("--servers", type=int, default=12, help="Number of local http servers for the rating benchmark.")
+    parser.add_argument("--db-size", type=int, default=256 * 1024, help="Size of the served database in bytes.")
+    parser.add_argument("--min-bandwidth", type=int, default=256 * 1024, help="Bandwidth of the slowest server in bytes per second.")
+    parser.add_argument("--max-bandwidth", type=int, default=8 * 1024 * 1024, help="Bandwidth of the fastest server in bytes per second.")
+    parser.add_argument("--max-latency", type=float, default=0.2, help="Maximum response latency of a server in seconds.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that a server fails a download.")
+    parser.add_argument("--threads", type=int, nargs="*", default=[4, 16], help="Thread counts for threaded rating, in addition to unthreaded rating.")
+    parser.add_argument("--timeout", type=int, default=5, help="Connection and download timeout for rating.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-processing", action="store_true")
+    parser.add_argument("--skip-rating", action="store_true")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    with tempfile.TemporaryDirectory(prefix="efly-bench__") as workdir:
+        workdir = Path(workdir)
+        # keep the mirror status caches of the benchmark away from the user's cache
+        os.environ["XDG_CACHE_HOME"] = str(workdir / "cache")
+
+        results = {
+            "benchmark": "reflector",
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        }
+        if not options.skip_processing:
+            results["processing"] = bench_processing(options.sizes, options.repeat, workdir)
+        if not options.skip_rating:
+            results["rating"] = bench_rating(options, workdir)
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# host folders shared with a vm: virtiofs ("efly qemu --share") against 9p ("-virtfs"). boots an image
+# headless with one empty host folder shared each way, logs in with ssh and runs the same workload on
+# both mounts inside the vm:
+#   write   sequential write of a large file, flushed with fsync
+#   read    sequential read of that file, with the page cache of the vm dropped before
+#   create  extract a tarball of many small files, like unpacking a source tree
+#   stat    list the size of all these files, with the caches of the vm dropped before
+#   delete  delete the files again
+#
+# the vm runs on a temporary overlay ("efly qemu --snapshot-overlay"), so the image is not modified.
+# ssh logs in without password (BatchMode): the public key of the host user has to be in the
+# authorized_keys of the image user, who runs the workload with sudo. images of efly have the user
+# "efly", which may use sudo without password.
+#
+# results are printed as json. compare result files with --compare.
+
+import argparse, json, os, platform, socket, statistics, subprocess, sys, tempfile, time
+from pathlib import Path
+
+repo_dir = Path(__file__).resolve().parent.parent
+mounts = ["virtiofs", "9p"]
+tests = ["write", "read", "create", "stat", "delete"]
+
+# runs as root inside the vm. prints "<mount> <test> <start> <end>" per test.
+workload = r"""
+set -e
+size_mb=$1
+files=$2
+now() { date +%s.%N; }
+drop_caches() { sync; echo 3 > /proc/sys/vm/drop_caches; }
+
+# the small files are generated in memory, so that only extracting them touches the shares
+rm -rf /tmp/share-bench
+mkdir -p /tmp/share-bench/src
+i=0
+while [ $i -lt $files ]; do
+    mkdir -p /tmp/share-bench/src/d$((i / 100))
+    printf '%4096s' x > /tmp/share-bench/src/d$((i / 100))/f$i
+    i=$((i + 1))
+done
+tar -cf /tmp/share-bench/small.tar -C /tmp/share-bench src
+
+mkdir -p /mnt/efly-virtiofs /mnt/efly-9p
+mountpoint -q /mnt/efly-virtiofs || mount -t virtiofs efly-virtiofs /mnt/efly-virtiofs
+mountpoint -q /mnt/efly-9p || mount -t 9p -o trans=virtio,version=9p2000.L,msize=524288 efly-9p /mnt/efly-9p
+
+for name in virtiofs 9p; do
+    dir=/mnt/efly-$name/run
+    mkdir -p $dir
+    t=$(now); dd if=/dev/zero of=$dir/big bs=1M count=$size_mb conv=fsync status=none; echo "$name write $t $(now)"
+    drop_caches
+    t=$(now); dd if=$dir/big of=/dev/null bs=1M status=none; echo "$name read $t $(now)"
+    # the files of the share belong to the host user. do not try to change their owner.
+    t=$(now); tar -xf /tmp/share-bench/small.tar --no-same-owner --no-same-permissions -C $dir; sync; echo "$name create $t $(now)"
+    drop_caches
+    t=$(now); find $dir/src -type f -printf '%s\n' > /dev/null; echo "$name stat $t $(now)"
+    t=$(now); rm -rf $dir; echo "$name delete $t $(now)"
+done
+rm -rf /tmp/share-bench
+"""
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "-C", repo_dir, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# ssh options of "efly fleet ssh", without password prompts
+def ssh_cmd(options, port):
+    return ["ssh", "-p", str(port), "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null",
+        "-o", "LogLevel=ERROR", "-o", "BatchMode=yes", "-o", "ConnectTimeout=5", f"{options.user}@localhost"]
+
+def start_vm(options, workdir, port):
+    shares = {name: workdir / name for name in mounts}
+    for path in shares.values():
+        path.mkdir()
+    cmd = [options.efly_qemu, "--headless", "--snapshot-overlay", "--name", f"share-bench-{os.getpid()}",
+        "--ssh-port", str(port), "--share", f"{shares['virtiofs']}:efly-virtiofs", options.image, "--",
+        "-virtfs", f"local,path={shares['9p']},mount_tag=efly-9p,security_model=none,id=efly-9p"]
+    log = open(workdir / "qemu.log", "w")
+    return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_for_ssh(options, vm, port):
+    deadline = time.monotonic() + options.boot_timeout
+    while time.monotonic() < deadline:
+        if vm.poll() is not None:
+            raise RuntimeError(f"the vm exited with code {vm.returncode}")
+        if subprocess.run(ssh_cmd(options, port) + ["true"], stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            return
+        time.sleep(2)
+    raise RuntimeError(f"no ssh login within {options.boot_timeout}s")
+
+# seconds per mount and test of one run of the workload
+def run_workload(options, port):
+    output = subprocess.check_output(ssh_cmd(options, port) + ["sudo", "sh", "-s", "--", str(options.size_mb), str(options.files)],
+        input=workload.encode())
+    seconds = {name: {} for name in mounts}
+    for line in output.decode().splitlines():
+        name, test, start, end = line.split()
+        seconds[name][test] = float(end) - float(start)
+    return seconds
+
+def stop_vm(options, vm, port):
+    subprocess.run(ssh_cmd(options, port) + ["sudo", "systemctl", "poweroff"], stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        vm.wait(60)
+    except subprocess.TimeoutExpired:
+        vm.terminate()
+        vm.wait()
+
+# median seconds, and MiB/s for the large file or files/s for the small files
+def summarize(runs, options):
+    summary = {}
+    for name in mounts:
+        for test in tests:
+            seconds = statistics.median(r[name][test] for r in runs)
+            if test in ("write", "read"):
+                summary[f"{name} {test} MiB/s"] = options.size_mb / seconds
+            else:
+                summary[f"{name} {test} files/s"] = options.files / seconds
+    return summary
+
+# print result files side by side. the change is relative to the first file.
+def compare(files):
+    results = [json.loads(Path(f).read_text()) for f in files]
+    labels = ["base", "new"] if len(results) == 2 else [Path(f).stem for f in files]
+    for label, result in zip(labels, results):
+        print(f"{label}: {result.get('commit')}")
+    print(f"{'':32s}" + "".join(f" {label[:10]:>10s} {'change' if i else '':>8s}" for i, label in enumerate(labels)))
+    summaries = [r.get("summary", {}) for r in results]
+    for key in dict.fromkeys(k for s in summaries for k in s):
+        values = [s.get(key) for s in summaries]
+        line = f"{key:32s}"
+        for i, value in enumerate(values):
+            change = f"{(value - values[0]) / values[0] * 100:+.1f}%" if i and values[0] and value is not None else ""
+            line += f" {'-' if value is None else f'{value:.1f}':>10s} {change:>8s}"
+        print(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Host folder sharing with a vm: virtiofs against 9p. Prints JSON.")
+    parser.add_argument("image", nargs="?", help="Raw disk image to boot, e.g. built by efly dd.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs of the workload. Default: %(default)s")
+    parser.add_argument("--size-mb", type=int, default=1024, help="Size of the large file in MiB. Default: %(default)s")
+    parser.add_argument("--files", type=int, default=10000, help="Number of small files. Default: %(default)s")
+    parser.add_argument("--user", default="efly", help="User to log in with ssh. Default: %(default)s")
+    parser.add_argument("--boot-timeout", type=int, default=300, help="Seconds to wait for ssh. Default: %(default)s")
+    parser.add_argument("--efly-qemu", default=str(repo_dir / "efly" / "efly-qemu"),
+        help="efly-qemu to run, e.g. from a git worktree of another commit. Default: %(default)s")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="Compare two or more result files and exit.")
+    options = parser.parse_args()
+    if not options.compare and not options.image:
+        parser.error("the image is required")
+    return options
+
+def main():
+    options = parse_args()
+    if options.compare:
+        compare(options.compare)
+        return
+
+    options.image = str(Path(options.image).resolve())
+    results = {
+        "benchmark": "share",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": platform.node(),
+        "kernel": platform.release(),
+        "options": {k: v for k, v in vars(options).items() if k not in ("compare", "output")},
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="efly-share-bench-") as workdir:
+        workdir = Path(workdir)
+        port = free_port()
+        vm = start_vm(options, workdir, port)
+        try:
+            wait_for_ssh(options, vm, port)
+            for i in range(options.runs):
+                results["runs"].append(run_workload(options, port))
+                print(f"[bench] run {i + 1}: " + ", ".join(f"{name} {sum(results['runs'][-1][name].values()):.1f}s" for name in mounts),
+                    file=sys.stderr)
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            print(f"[bench] error: {e}. qemu log:\n" + (workdir / "qemu.log").read_text(errors="replace")[-4000:], file=sys.stderr)
+            sys.exit(1)
+        finally:
+            stop_vm(options, vm, port)
+    results["summary"] = summarize(results["runs"], options)
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
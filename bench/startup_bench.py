@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# startup time of the efly command line. runs short commands that exit right after parsing their
+# arguments, like "efly --help" and "efly dd --help", many times and records the wall time of each.
+# this is the overhead every call of efly pays, which adds up in scripts that call efly repeatedly.
+#
+# each command is run once more with PYTHONPROFILEIMPORTTIME set, which makes python log the time
+# spent importing each module, in the efly process and in any python process it starts. the modules
+# with the largest import time are listed per command.
+#
+# results are printed as json. compare result files with --compare.
+
+import argparse, json, os, platform, statistics, subprocess, sys, time
+from pathlib import Path
+
+repo_dir = Path(__file__).resolve().parent.parent
+
+commands = [
+    ["--help"],
+    ["dd", "--help"],
+    ["dd", "--version"],
+    ["flash", "--help"],
+    ["fleet", "--help"],
+    ["snapshot", "--help"],
+    ["store", "--help"],
+]
+
+def git_commit(path):
+    try:
+        return subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_once(efly, args, env=None):
+    start = time.perf_counter()
+    completed = subprocess.run([efly] + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    return time.perf_counter() - start, completed
+
+# "import time: self [us] | cumulative | imported package" lines of all python processes started
+def import_times(efly, args):
+    _, completed = run_once(efly, args, dict(os.environ, PYTHONPROFILEIMPORTTIME="1"))
+    modules = {}
+    processes = 0
+    for line in completed.stderr.decode(errors="replace").splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = [f.strip() for f in line[len("import time:"):].split("|")]
+        if not fields[0].isdigit():
+            processes += 1
+            continue
+        name = fields[2].strip()
+        if name == "encodings":
+            continue
+        modules[name.split(".")[0]] = modules.get(name.split(".")[0], 0) + int(fields[0])
+    top = sorted(modules.items(), key=lambda item: -item[1])[:8]
+    return {
+        "python_processes": processes,
+        "modules": len(modules),
+        "import_ms": sum(modules.values()) / 1000,
+        "top_ms": {name: us / 1000 for name, us in top},
+    }
+
+def bench_command(efly, args, runs):
+    # one warm-up run fills the page cache and the bytecode cache
+    _, completed = run_once(efly, args)
+    times = [run_once(efly, args)[0] for _ in range(runs)]
+    return {
+        "command": " ".join(["efly"] + args),
+        "returncode": completed.returncode,
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "max_ms": max(times) * 1000,
+        "imports": import_times(efly, args),
+    }
+
+def compare(files):
+    results = [json.loads(Path(f).read_text()) for f in files]
+    labels = ["base", "new"] if len(results) == 2 else [Path(f).stem for f in files]
+    for label, result in zip(labels, results):
+        print(f"{label}: {result.get('commit')}")
+    print(f"{'median ms':32s}" + "".join(f" {label[:10]:>10s} {'change' if i else '':>8s}" for i, label in enumerate(labels)))
+    by_command = [{c["command"]: c for c in r["commands"]} for r in results]
+    for command in dict.fromkeys(c for r in by_command for c in r):
+        values = [r.get(command, {}).get("median_ms") for r in by_command]
+        line = f"{command:32s}"
+        for i, value in enumerate(values):
+            change = f"{(value - values[0]) / values[0] * 100:+.1f}%" if i and values[0] and value is not None else ""
+            line += f" {'-' if value is None else f'{value:.1f}':>10s} {change:>8s}"
+        print(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Startup time of the efly command line. Prints JSON.")
+    parser.add_argument("--runs", type=int, default=20, help="Number of timed runs per command. Default: %(default)s")
+    parser.add_argument("--efly", default=str(repo_dir / "efly" / "efly"),
+        help="efly to run, e.g. from a git worktree of another commit. Default: %(default)s")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="Compare two or more result files and exit.")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    if options.compare:
+        compare(options.compare)
+        return
+
+    efly = str(Path(options.efly).resolve())
+    results = {
+        "benchmark": "startup",
+        "commit": git_commit(Path(efly).parent),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "options": {k: v for k, v in vars(options).items() if k not in ("compare", "output")},
+        "commands": [],
+    }
+    for args in commands:
+        results["commands"].append(bench_command(efly, args, options.runs))
+        c = results["commands"][-1]
+        print(f"[bench] {c['command']}: {c['median_ms']:.1f}ms, returncode {c['returncode']}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + "\n")
+    else:
+        print(output)
+    if any(c["returncode"] != 0 for c in results["commands"]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
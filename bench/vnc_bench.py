@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+# benchmark of the "efly vncserver" presets (data/vncserver-presets.conf). for each preset, a local Xvnc
+# is started with the server options of the preset, a scripted workload (vnc_workload.py) draws on it
+# and a headless rfb client requests updates with the encodings of the preset for a fixed time.
+#
+# the client only parses the update messages, it does not decode pixels. reported per preset: frames
+# (non-empty updates) per second, bytes per frame, throughput and update latency (time from an update
+# request until the update was received). the link of the preset (lan, wan, cellular) is emulated by
+# the client: the socket is read with limited bandwidth and requests are delayed by the round trip time.
+#
+# requires Xvnc (tigervnc) and python tkinter for the workload. results are printed as json.
+
+import argparse, json, os, platform, re, socket, statistics, struct, subprocess, sys, tempfile, time
+from pathlib import Path
+
+repo_dir = Path(__file__).resolve().parent.parent
+presets_file = repo_dir / "data" / "vncserver-presets.conf"
+
+# emulated links: bandwidth in bytes per second (None: unlimited) and round trip time in seconds
+links = {
+    "lan": (None, 0.0),
+    "wan": (20e6 / 8, 0.04),
+    "cellular": (4e6 / 8, 0.1),
+}
+
+encoding_numbers = {"raw": 0, "copyrect": 1, "zrle": 16, "tight": 7}
+encoding_names = {v: k for k, v in encoding_numbers.items()}
+pseudo_last_rect = -224
+pseudo_desktop_size = -223
+
+# server and viewer options of the presets. see data/vncserver-presets.conf.
+def read_presets(path=presets_file):
+    presets, section = {}, None
+    for line in Path(path).read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if match := re.match(r"\[(\w+)\]", line):
+            section = presets.setdefault(match[1], {"server": [], "viewer": {}})
+        elif match := re.match(r"server\s*=\s*(.*)", line):
+            section["server"] = match[1].split()
+        elif match := re.match(r"viewer\s*=\s*(.*)", line):
+            for option in match[1].split():
+                key, _, value = option.lstrip("-").partition("=")
+                section["viewer"][key.lower()] = value
+    return presets
+
+# ---- rfb client ---- #
+
+class RfbClient:
+    def __init__(self, port, bandwidth=None, rtt=0.0):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.bandwidth = bandwidth
+        self.rtt = rtt
+        self.received = 0
+        self.link_free_at = time.monotonic()
+
+    # read exactly n bytes. with limited bandwidth, the data is only available after it has
+    # "arrived" over the emulated link.
+    def read(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.sock.recv(min(n - len(data), 1 << 16))
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            data += chunk
+        self.received += n
+        if self.bandwidth:
+            self.link_free_at = max(self.link_free_at, time.monotonic()) + n / self.bandwidth
+            delay = self.link_free_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return bytes(data)
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+    def handshake(self, full_color):
+        version = self.read(12)
+        if not version.startswith(b"RFB 003."):
+            raise RuntimeError(f"not an rfb server: {version!r}")
+        self.sock.sendall(b"RFB 003.008\n")
+        count, = self.unpack(">B")
+        types = self.read(count)
+        if 1 not in types:
+            raise RuntimeError("server requires authentication. start Xvnc with -SecurityTypes None.")
+        self.sock.sendall(b"\x01")
+        result, = self.unpack(">I")
+        if result != 0:
+            raise RuntimeError("rfb security handshake failed")
+        self.sock.sendall(b"\x01") # shared
+        self.width, self.height = self.unpack(">HH")
+        self.read(16) # server pixel format
+        name_length, = self.unpack(">I")
+        self.read(name_length)
+
+        # like vncviewer: 32 bit true color, or 8 bit (rgb332) for low color
+        if full_color:
+            self.bpp, self.depth, self.max_rgb, self.shift = 32, 24, (255, 255, 255), (16, 8, 0)
+        else:
+            self.bpp, self.depth, self.max_rgb, self.shift = 8, 8, (7, 7, 3), (5, 2, 0)
+        pixel_format = struct.pack(">BBBBHHHBBB3x", self.bpp, self.depth, 0, 1, *self.max_rgb, *self.shift)
+        self.sock.sendall(struct.pack(">B3x", 0) + pixel_format)
+        # tight sends 3 byte pixels for 24 bit true color
+        self.tight_pixel = 3 if self.bpp == 32 and self.depth == 24 and self.max_rgb == (255, 255, 255) else self.bpp // 8
+
+    def set_encodings(self, encodings):
+        self.sock.sendall(struct.pack(f">BxH{len(encodings)}i", 2, len(encodings), *encodings))
+
+    def request_update(self, incremental=True):
+        if self.rtt:
+            time.sleep(self.rtt / 2)
+        self.sock.sendall(struct.pack(">BBHHHH", 3, 1 if incremental else 0, 0, 0, self.width, self.height))
+
+    # the compact length of the tight encoding: 1 to 3 bytes with 7 bits each
+    def tight_length(self):
+        length, shift = 0, 0
+        for _ in range(3):
+            byte, = self.unpack(">B")
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return length
+
+    def skip_tight(self, w, h):
+        control, = self.unpack(">B")
+        kind = control >> 4
+        if kind == 0x8: # fill
+            self.read(self.tight_pixel)
+            return
+        if kind == 0x9: # jpeg
+            self.read(self.tight_length())
+            return
+        if kind & 0x8:
+            raise RuntimeError(f"unknown tight compression control {control:#x}")
+        row_bytes = w * self.tight_pixel
+        if kind & 0x4: # explicit filter
+            filter_id, = self.unpack(">B")
+            if filter_id == 1: # palette
+                colors, = self.unpack(">B")
+                colors += 1
+                self.read(colors * self.tight_pixel)
+                row_bytes = (w + 7) // 8 if colors == 2 else w
+        size = row_bytes * h
+        # data smaller than 12 bytes is not compressed
+        self.read(size if size < 12 else self.tight_length())
+
+    # read a framebuffer update. returns the number of non-empty rectangles and their encodings.
+    def read_update(self):
+        while True:
+            message, = self.unpack(">B")
+            if message == 0:
+                break
+            if message == 1: # color map
+                _, count = self.unpack(">xHH")
+                self.read(count * 6)
+            elif message == 2: # bell
+                pass
+            elif message == 3: # cut text
+                length, = self.unpack(">3xI")
+                self.read(length)
+            else:
+                raise RuntimeError(f"unknown rfb message type {message}")
+
+        count, = self.unpack(">xH")
+        rects, encodings = 0, {}
+        for _ in range(count):
+            x, y, w, h, encoding = self.unpack(">HHHHi")
+            if encoding == pseudo_last_rect:
+                break
+            if encoding == pseudo_desktop_size:
+                self.width, self.height = w, h
+                continue
+            if encoding == 0:
+                self.read(w * h * self.bpp // 8)
+            elif encoding == 1:
+                self.read(4)
+            elif encoding == 16:
+                length, = self.unpack(">I")
+                self.read(length)
+            elif encoding == 7:
+                self.skip_tight(w, h)
+            else:
+                raise RuntimeError(f"unexpected encoding {encoding}")
+            rects += 1
+            name = encoding_names.get(encoding, str(encoding))
+            encodings[name] = encodings.get(name, 0) + 1
+        return rects, encodings
+
+    def close(self):
+        self.sock.close()
+
+# encodings the viewer would announce for the given viewer options, preferred encoding first
+def client_encodings(viewer):
+    preferred = viewer.get("preferredencoding", "tight").lower()
+    encodings = [encoding_numbers[preferred]] + [n for e, n in encoding_numbers.items() if e != preferred]
+    if "qualitylevel" in viewer:
+        encodings.append(-32 + int(viewer["qualitylevel"]))
+    if "compresslevel" in viewer:
+        encodings.append(-256 + int(viewer["compresslevel"]))
+    return encodings + [pseudo_last_rect, pseudo_desktop_size]
+
+# ---- xvnc ---- #
+
+def free_display():
+    for n in range(50, 100):
+        if Path(f"/tmp/.X{n}-lock").exists() or Path(f"/tmp/.X11-unix/X{n}").exists():
+            continue
+        with socket.socket() as s:
+            try:
+                s.bind(("127.0.0.1", 5900 + n))
+            except OSError:
+                continue
+        return n
+    raise RuntimeError("no free X display number")
+
+# start Xvnc and wait until it is ready (it writes the display number to -displayfd)
+def start_xvnc(display, geometry, server_options, log):
+    read_fd, write_fd = os.pipe()
+    cmd = ["Xvnc", f":{display}", "-geometry", geometry, "-SecurityTypes", "None", "-localhost",
+        "-rfbport", str(5900 + display), "-displayfd", str(write_fd)] + server_options
+    process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, pass_fds=[write_fd])
+    os.close(write_fd)
+    with os.fdopen(read_fd) as ready:
+        if not ready.readline().strip():
+            raise RuntimeError(f"Xvnc failed to start: {' '.join(cmd)}")
+    return process
+
+def bench_preset(name, preset, options, workdir):
+    bandwidth, rtt = (None, 0.0) if options.link == "none" else links.get(options.link or name, (None, 0.0))
+    display = free_display()
+    log = open(workdir / f"{name}.log", "w")
+    xvnc = start_xvnc(display, options.geometry, preset["server"], log)
+    workload = None
+    client = None
+    try:
+        env = dict(os.environ, DISPLAY=f":{display}")
+        workload_cmd = options.workload.split() if options.workload else \
+            [sys.executable, str(Path(__file__).with_name("vnc_workload.py")), "--fps", str(options.workload_fps)]
+        workload = subprocess.Popen(workload_cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        client = RfbClient(5900 + display, bandwidth, rtt)
+        client.handshake(full_color=preset["viewer"].get("fullcolor", "1") != "0")
+        client.set_encodings(client_encodings(preset["viewer"]))
+
+        # initial full update, then let the workload settle
+        client.request_update(incremental=False)
+        client.read_update()
+        end = time.monotonic() + options.warmup
+        while time.monotonic() < end:
+            client.request_update()
+            client.read_update()
+
+        frames, latencies, sizes, encodings = 0, [], [], {}
+        received = client.received
+        start = time.monotonic()
+        while time.monotonic() - start < options.duration:
+            requested = time.monotonic()
+            before = client.received
+            client.request_update()
+            rects, used = client.read_update()
+            if rects:
+                frames += 1
+                latencies.append(time.monotonic() - requested)
+                sizes.append(client.received - before)
+                for encoding, count in used.items():
+                    encodings[encoding] = encodings.get(encoding, 0) + count
+        elapsed = time.monotonic() - start
+        received = client.received - received
+    finally:
+        if client:
+            client.close()
+        for process in [workload, xvnc]:
+            if process:
+                process.terminate()
+                process.wait()
+        log.close()
+
+    return {
+        "server_options": preset["server"],
+        "viewer_options": preset["viewer"],
+        "link": {"bandwidth_bytes_per_second": bandwidth, "rtt_seconds": rtt},
+        "seconds": elapsed,
+        "frames": frames,
+        "fps": frames / elapsed,
+        "bytes_per_frame": statistics.mean(sizes) if sizes else 0,
+        "kib_per_second": received / elapsed / 1024,
+        "latency_median_ms": statistics.median(latencies) * 1000 if latencies else None,
+        "latency_p95_ms": sorted(latencies)[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+        "encodings": encodings,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "-C", repo_dir, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of the efly vncserver presets against a local Xvnc. Prints JSON.")
+    parser.add_argument("--presets", nargs="+", help="Presets to run. Default: all presets of the presets file.")
+    parser.add_argument("--presets-file", default=str(presets_file), help="Default: %(default)s")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of measurement per preset.")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds before the measurement starts.")
+    parser.add_argument("--geometry", default="1280x800")
+    parser.add_argument("--link", choices=["none"] + list(links),
+        help="Emulate this link for all presets. \"none\": no emulation. Default: the link named like the preset.")
+    parser.add_argument("--workload", help="Command to draw on the display instead of vnc_workload.py.")
+    parser.add_argument("--workload-fps", type=int, default=30, help="Frames per second of vnc_workload.py.")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout.")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    presets = read_presets(options.presets_file)
+    names = options.presets or list(presets)
+    for name in names:
+        if name not in presets:
+            print(f"[bench] unknown preset: {name}", file=sys.stderr)
+            sys.exit(1)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="efly-vnc-bench__") as tmp:
+        for name in names:
+            print(f"[bench] preset {name}", file=sys.stderr)
+            results[name] = bench_preset(name, presets[name], options, Path(tmp))
+            r = results[name]
+            print(f"[bench] {name}: {r['fps']:.1f} fps, {r['bytes_per_frame'] / 1024:.1f} KiB/frame, "
+                f"latency {r['latency_median_ms'] or 0:.1f} ms", file=sys.stderr)
+
+    output = json.dumps({
+        "benchmark": "vncserver",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": platform.node(),
+        "options": vars(options),
+        "presets": results,
+    }, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# scripted desktop workload for vnc_bench.py. draws on the X display given by $DISPLAY: moving
+# rectangles (solid areas, cheap to encode), a gradient band (photo-like content for jpeg), scrolling
+# text (lots of small changes) and a frame counter. the drawing is the same in every run.
+
+import argparse, random, tkinter
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fps", type=int, default=30, help="Frames drawn per second.")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    root = tkinter.Tk()
+    root.attributes("-fullscreen", True)
+    root.update()
+    width, height = root.winfo_width(), root.winfo_height()
+    canvas = tkinter.Canvas(root, width=width, height=height, background="white", highlightthickness=0)
+    canvas.pack()
+
+    colors = ["#e6194b", "#3cb44b", "#4363d8", "#f58231", "#911eb4", "#46f0f0", "#f032e6", "#bcf60c"]
+    boxes = []
+    for i in range(12):
+        x, y = rng.randrange(width - 120), rng.randrange(height // 2)
+        boxes.append((canvas.create_rectangle(x, y, x + 120, y + 80, fill=colors[i % len(colors)], outline=""),
+            rng.choice([-6, -4, 4, 6]), rng.choice([-5, -3, 3, 5])))
+
+    # gradient band of 1 pixel wide lines, recolored every frame
+    band_top = height // 2
+    band = [canvas.create_line(x, band_top, x, band_top + 120) for x in range(0, width, 2)]
+
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+    lines = [canvas.create_text(10, band_top + 140 + 16 * i, anchor="nw", font=("monospace", 10), text="")
+        for i in range((height - band_top - 160) // 16)]
+    counter = canvas.create_text(width - 10, 10, anchor="ne", font=("monospace", 14, "bold"), text="")
+
+    frame = 0
+    def draw():
+        nonlocal frame
+        frame += 1
+        for i, (item, dx, dy) in enumerate(boxes):
+            x0, y0, x1, y1 = canvas.coords(item)
+            if x0 + dx < 0 or x1 + dx > width:
+                dx = -dx
+            if y0 + dy < 0 or y1 + dy > band_top:
+                dy = -dy
+            canvas.move(item, dx, dy)
+            boxes[i] = (item, dx, dy)
+        for i, line in enumerate(band):
+            shade = (i * 2 + frame * 3) % 256
+            canvas.itemconfigure(line, fill=f"#{shade:02x}{(shade * 3) % 256:02x}{255 - shade:02x}")
+        # scroll the text by one line
+        for line, following in zip(lines, lines[1:]):
+            canvas.itemconfigure(line, text=canvas.itemcget(following, "text"))
+        canvas.itemconfigure(lines[-1], text=" ".join(rng.choice(words) for _ in range(14)) + f" {frame}")
+        canvas.itemconfigure(counter, text=f"frame {frame}")
+        root.after(1000 // options.fps, draw)
+
+    draw()
+    root.mainloop()
+
+if __name__ == "__main__":
+    main()
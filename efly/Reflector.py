@@ -92,6 +92,18 @@ def get_cache_file(name='mirrorstatus.json'):
     return path
 
 
+def get_cache_path(url=URL):
+    '''
+    Get the path of the local cache file for the mirror status data retrieved
+    from the given URL.
+    '''
+    if url == URL:
+        return get_cache_file()
+    name = base64.urlsafe_b64encode(url.encode('utf-8')).decode('utf-8') + '.json'
+    name = os.path.join(NAME, name)
+    return get_cache_file(name=name)
+
+
 def get_mirrorstatus(
     connection_timeout=DEFAULT_CONNECTION_TIMEOUT,
     cache_timeout=DEFAULT_CACHE_TIMEOUT,
@@ -102,12 +114,7 @@ def get_mirrorstatus(
     locally and re-used within the cache timeout period. Returns the object and
     the local cache's modification time.
     '''
-    if url == URL:
-        cache_path = get_cache_file()
-    else:
-        name = base64.urlsafe_b64encode(url.encode('utf-8')).decode('utf-8') + '.json'
-        name = os.path.join(NAME, name)
-        cache_path = get_cache_file(name=name)
+    cache_path = get_cache_path(url)
 
     try:
         mtime = os.path.getmtime(cache_path)
@@ -134,6 +141,53 @@ def get_mirrorstatus(
         ) from err
 
 
+def get_mirror_index(mirror_status, url=URL):
+    '''
+    Get the compiled MirrorIndex for a mirror status object. The index is
+    cached next to the mirror status JSON file and is rebuilt whenever the
+    "last_check" field of the mirror status changes.
+    '''
+    index_path = get_cache_path(url) + '.index'
+    last_check = mirror_status.get('last_check')
+
+    try:
+        with open(index_path, 'r', encoding='utf-8') as handle:
+            obj = json.load(handle)
+        if obj.get('version') == MirrorIndex.VERSION and obj.get('last_check') == last_check:
+            return MirrorIndex.from_obj(obj)
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        index = MirrorIndex(mirror_status['urls'])
+    except KeyError as err:
+        raise MirrorStatusError('no mirrors detected in mirror status output') from err
+
+    # The cache is only an optimization. Failing to write it is not an error.
+    # It is written to a temporary file and moved into place, so that an
+    # interrupted or concurrent run never leaves a truncated index behind.
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            'w',
+            encoding='utf-8',
+            dir=os.path.dirname(index_path),
+            prefix=os.path.basename(index_path) + '.',
+            delete=False
+        ) as handle:
+            tmp_path = handle.name
+            json.dump(index.to_obj(last_check), handle)
+        os.replace(tmp_path, index_path)
+    except IOError:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except IOError:
+                pass
+
+    return index
+
+
 # ------------------------------ Miscellaneous ------------------------------- #
 
 def get_logger():
@@ -144,16 +198,6 @@ def get_logger():
     return logging.getLogger(NAME)
 
 
-def format_last_sync(mirrors):
-    '''
-    Parse and format the "last_sync" field.
-    '''
-    for mirror in mirrors:
-        last_sync = calendar.timegm(time.strptime(mirror['last_sync'], PARSE_TIME_FORMAT))
-        mirror.update(last_sync=last_sync)
-        yield mirror
-
-
 def count_countries(mirrors):
     '''
     Count the mirrors in each country.
@@ -183,27 +227,21 @@ def country_sort_key(priorities):
     Returns:
         A key function to pass to sort().
     '''
-    priorities = [country.upper() for country in priorities]
-    try:
-        default_priority = priorities.index('*')
-    except ValueError:
-        default_priority = len(priorities)
+    # Map each country to the position of its first occurrence so that the key
+    # function does a dictionary lookup instead of a linear search.
+    ranks = {}
+    for i, country in enumerate(priorities):
+        ranks.setdefault(country.upper(), i)
+    default_priority = ranks.get('*', len(priorities))
 
     def key_func(mirror):
         country = mirror['country'].upper()
         code = mirror['country_code'].upper()
 
-        try:
-            return (priorities.index(country), country)
-        except ValueError:
-            pass
-
-        try:
-            return (priorities.index(code), country)
-        except ValueError:
-            pass
-
-        return (default_priority, country)
+        rank = ranks.get(country)
+        if rank is None:
+            rank = ranks.get(code, default_priority)
+        return (rank, country)
 
     return key_func
 
@@ -266,7 +304,7 @@ class DownloadTimer():
 
 # --------------------------------- Sorting ---------------------------------- #
 
-def sort(mirrors, by=None, key=None, **kwargs):  # pylint: disable=invalid-name
+def sort(mirrors, by=None, key=None, index=None, **kwargs):  # pylint: disable=invalid-name
     '''
     Sort mirrors by different criteria.
 
@@ -285,6 +323,10 @@ def sort(mirrors, by=None, key=None, **kwargs):  # pylint: disable=invalid-name
             A custom sorting function that accepts mirrors and returns a sort
             key. If given, it will override the "by" parameter.
 
+        index:
+            The MirrorIndex that the mirrors were selected from. Its
+            precomputed sort keys are used if all mirrors belong to it.
+
         **kwargs:
             Keyword arguments that are passed through to rate() when "by" is
             "rate".
@@ -296,6 +338,16 @@ def sort(mirrors, by=None, key=None, **kwargs):  # pylint: disable=invalid-name
     if not isinstance(mirrors, list):
         mirrors = list(mirrors)
 
+    if key is None and index is not None and by in index.sort_ranks:
+        ranks = index.sort_ranks[by]
+        positions = index.positions
+        try:
+            mirrors.sort(key=lambda m: ranks[positions[id(m)]])
+            return mirrors
+        except KeyError:
+            # Some mirrors are not from the index. Sort them by their fields.
+            pass
+
     if by == 'age':
         mirrors.sort(key=lambda m: m['last_sync'], reverse=True)
 
@@ -437,6 +489,11 @@ def _rate_threaded(mirrors, fmt, n_threads, kwargs):  # pylint: disable=too-many
     return rates
 
 
+# download rates in bytes per second of all mirrors rated so far, by url. efly keeps them with the
+# mirror list for its build metrics.
+last_rates = {}
+
+
 def rate(
     mirrors,
     n_threads=0,
@@ -462,8 +519,11 @@ def rate(
     fmt = f'{{:{url_len:d}s}}  {{:8.2f}} KiB/s  {{:7.2f}} s'
 
     if n_threads > 0:
-        return _rate_threaded(mirrors, fmt, n_threads, kwargs)
-    return _rate_unthreaded(mirrors, fmt, kwargs)
+        rates = _rate_threaded(mirrors, fmt, n_threads, kwargs)
+    else:
+        rates = _rate_unthreaded(mirrors, fmt, kwargs)
+    last_rates.update(rates)
+    return rates
 
 
 # -------------------------------- Exceptions -------------------------------- #
@@ -514,63 +574,198 @@ class MirrorStatusFilter():  # pylint: disable=too-many-instance-attributes,too-
 
     def filter_mirrors(self, mirrors):
         '''
-        Filter the mirrors.
+        Filter the mirrors. The mirrors may be given as a MirrorIndex or as an
+        iterable of mirror status entries, which will be compiled into a
+        temporary index.
         '''
-        # Filter unsynced mirrors.
-        mirrors = (m for m in mirrors if m['last_sync'])
+        if not isinstance(mirrors, MirrorIndex):
+            mirrors = MirrorIndex(mirrors)
+        yield from mirrors.select(self)
 
-        # Parse the last sync time.
-        mirrors = format_last_sync(mirrors)
 
-        # Filter by completion "percent" [0-1].
-        mirrors = (m for m in mirrors if m['completion_pct'] >= self.min_completion_pct)
+# ------------------------------- Mirror Index ------------------------------- #
 
-        # Filter by countries.
-        countries = self.countries
-        if countries and '*' not in countries:
-            mirrors = (
-                m for m in mirrors
-                if m['country'].upper() in countries or m['country_code'].upper() in countries
-            )
+class MirrorIndex():  # pylint: disable=too-many-instance-attributes
+    '''
+    Compiled, read-only view of the mirrors of a mirror status object.
+
+    The index is built once per mirror status. The "last_sync" fields are parsed
+    to epoch seconds, unsynced mirrors are dropped and the mirrors are grouped
+    by country, protocol and flags into sets of positions, so that filtering
+    becomes a series of set operations. The indexed mirrors are copies of the
+    original entries and are never modified, so the same index can be filtered
+    any number of times.
+    '''
 
-        # Filter by protocols.
-        if self.protocols:
-            mirrors = (m for m in mirrors if m['protocol'] in self.protocols)
+    # Bump this when the serialized format changes.
+    VERSION = 1
+
+    __slots__ = (
+        'mirrors',
+        'last_sync',
+        'completion_pct',
+        'delay',
+        'by_country',
+        'by_protocol',
+        'isos',
+        'ipv4',
+        'ipv6',
+        'positions',
+        'sort_ranks',
+    )
 
-        # Filter by include expressions.
-        if self.include:
-            mirrors = (m for m in mirrors if any(r.search(m['url']) for r in self.include))
+    def __init__(self, mirrors, parsed=False):
+        '''
+        Args:
+            mirrors:
+                An iterable of mirror status entries.
 
-        # Filter by exclude expressions.
-        if self.exclude:
-            mirrors = (m for m in mirrors if not any(r.search(m['url']) for r in self.exclude))
+            parsed:
+                If True, the "last_sync" fields are already epoch seconds, e.g.
+                when the mirrors are loaded from a cached index.
+        '''
+        compiled = []
+        for mirror in mirrors:
+            last_sync = mirror['last_sync']
+            if not last_sync:
+                continue
+            if not parsed and isinstance(last_sync, str):
+                last_sync = calendar.timegm(time.strptime(last_sync, PARSE_TIME_FORMAT))
+            mirror = dict(mirror, last_sync=last_sync)
+            for key in ('country', 'country_code', 'protocol'):
+                mirror[key] = sys.intern(mirror[key])
+            compiled.append(mirror)
+
+        self.mirrors = tuple(compiled)
+        self.last_sync = tuple(m['last_sync'] for m in compiled)
+        self.completion_pct = tuple(m['completion_pct'] for m in compiled)
+        # Mirrors without a reported delay never pass the delay filter.
+        self.delay = tuple(
+            float('inf') if m['delay'] is None else m['delay'] for m in compiled
+        )
 
-        # Filter by age. The age is given in hours and converted to seconds. Servers
-        # with a last refresh older than the age are omitted.
-        if self.age and self.age > 0:
-            tim = time.time()
-            age = self.age * 60**2
-            mirrors = (m for m in mirrors if (m['last_sync'] + age) >= tim)
+        by_country = {}
+        by_protocol = {}
+        for i, mirror in enumerate(compiled):
+            for key in {mirror['country'].upper(), mirror['country_code'].upper()}:
+                by_country.setdefault(sys.intern(key), set()).add(i)
+            by_protocol.setdefault(mirror['protocol'], set()).add(i)
+        self.by_country = {k: frozenset(v) for k, v in by_country.items()}
+        self.by_protocol = {k: frozenset(v) for k, v in by_protocol.items()}
+
+        self.isos = frozenset(i for i, m in enumerate(compiled) if m['isos'])
+        self.ipv4 = frozenset(i for i, m in enumerate(compiled) if m['ipv4'])
+        self.ipv6 = frozenset(i for i, m in enumerate(compiled) if m['ipv6'])
+
+        # Precomputed sort keys: the rank of each mirror per sort criterion, so
+        # that sorting compares integers instead of looking up fields. Equal
+        # values get equal ranks, which keeps the sort stable. Mirrors without
+        # a score or delay are sorted last.
+        self.positions = {id(m): i for i, m in enumerate(compiled)}
+        self.sort_ranks = {
+            'age': self._ranks(-last_sync for last_sync in self.last_sync),
+            'score': self._ranks(
+                float('inf') if m.get('score') is None else m['score'] for m in compiled
+            ),
+            'delay': self._ranks(self.delay),
+            'country': self._ranks(m['country'] for m in compiled),
+        }
+
+    @staticmethod
+    def _ranks(values):
+        '''
+        Return the dense rank of each of the values.
+        '''
+        values = tuple(values)
+        ranks = {value: i for i, value in enumerate(sorted(set(values)))}
+        return tuple(ranks[value] for value in values)
 
-        # Filter by delay. The delay is given as a float of hours and must be
-        # converted to seconds.
-        if self.delay is not None:
-            delay = self.delay * 3600
-            mirrors = (m for m in mirrors if m['delay'] <= delay)
+    def __len__(self):
+        return len(self.mirrors)
 
-        # Filter by ISO hosing.
-        if self.isos:
-            mirrors = (m for m in mirrors if m['isos'])
+    def __iter__(self):
+        return iter(self.mirrors)
 
-        # Filter by IPv4 support.
-        if self.ipv4:
-            mirrors = (m for m in mirrors if m['ipv4'])
+    @classmethod
+    def from_obj(cls, obj):
+        '''
+        Load an index from the object returned by to_obj().
+        '''
+        return cls(obj['mirrors'], parsed=True)
 
-        # Filter by IPv6 support.
-        if self.ipv6:
-            mirrors = (m for m in mirrors if m['ipv6'])
+    def to_obj(self, last_check=None):
+        '''
+        Return a JSON-serializable representation of the index. The "last_check"
+        field of the indexed mirror status is stored to detect stale caches.
+        '''
+        return {
+            'version': self.VERSION,
+            'last_check': last_check,
+            'mirrors': self.mirrors,
+        }
 
-        yield from mirrors
+    def _union(self, groups, keys):
+        '''
+        Return the union of the position sets of the given keys.
+        '''
+        selected = set()
+        for key in keys:
+            selected |= groups.get(key, frozenset())
+        return selected
+
+    def select(self, msf):  # pylint: disable=too-many-branches
+        '''
+        Return the mirrors that pass the given MirrorStatusFilter, in their
+        original order.
+        '''
+        # Filter by completion "percent" [0-1].
+        min_pct = msf.min_completion_pct
+        selected = {i for i, pct in enumerate(self.completion_pct) if pct >= min_pct}
+
+        # Filter by countries.
+        countries = msf.countries
+        if countries and '*' not in countries:
+            selected &= self._union(self.by_country, countries)
+
+        # Filter by protocols.
+        if msf.protocols:
+            selected &= self._union(self.by_protocol, msf.protocols)
+
+        # Filter by ISO hosting and IP version support.
+        if msf.isos:
+            selected &= self.isos
+        if msf.ipv4:
+            selected &= self.ipv4
+        if msf.ipv6:
+            selected &= self.ipv6
+
+        # Filter by age. The age is given in hours and converted to seconds.
+        # Servers with a last refresh older than the age are omitted.
+        if msf.age and msf.age > 0:
+            oldest = time.time() - msf.age * 60**2
+            last_sync = self.last_sync
+            selected = {i for i in selected if last_sync[i] >= oldest}
+
+        # Filter by delay. The delay is given as a float of hours and must be
+        # converted to seconds.
+        if msf.delay is not None:
+            max_delay = msf.delay * 3600
+            delay = self.delay
+            selected = {i for i in selected if delay[i] <= max_delay}
+
+        # Filter by include and exclude expressions. These are the most
+        # expensive checks, so they only run on the remaining mirrors.
+        mirrors = self.mirrors
+        if msf.include:
+            selected = {
+                i for i in selected if any(r.search(mirrors[i]['url']) for r in msf.include)
+            }
+        if msf.exclude:
+            selected = {
+                i for i in selected if not any(r.search(mirrors[i]['url']) for r in msf.exclude)
+            }
+
+        return [mirrors[i] for i in sorted(selected)]
 
 
 # -------------------------------- Formatting -------------------------------- #
@@ -682,6 +877,7 @@ class MirrorStatus():
         self.url = url
 
         self.mirror_status = None
+        self.mirror_index = None
         self.ms_mtime = 0
         self.n_threads = n_threads
 
@@ -694,6 +890,7 @@ class MirrorStatus():
             cache_timeout=self.cache_timeout,
             url=self.url
         )
+        self.mirror_index = None
 
     def get_obj(self):
         '''
@@ -714,12 +911,22 @@ class MirrorStatus():
         except KeyError as err:
             raise MirrorStatusError('no mirrors detected in mirror status output') from err
 
+    def get_index(self):
+        '''
+        Get the compiled MirrorIndex of the mirror status. It is built once per
+        retrieved mirror status and re-used by subsequent filters.
+        '''
+        obj = self.get_obj()
+        if self.mirror_index is None:
+            self.mirror_index = get_mirror_index(obj, url=self.url)
+        return self.mirror_index
+
     def filter(self, mirrors=None, **kwargs):
         '''
         Filter mirrors by various criteria.
         '''
         if mirrors is None:
-            mirrors = self.get_mirrors()
+            mirrors = self.get_index()
         msf = MirrorStatusFilter(min_completion_pct=self.min_completion_pct, **kwargs)
         yield from msf.filter_mirrors(mirrors)
 
@@ -731,7 +938,7 @@ class MirrorStatus():
             mirrors = self.get_mirrors()
         kwargs.setdefault('connection_timeout', self.connection_timeout)
         kwargs.setdefault('download_timeout', self.download_timeout)
-        yield from sort(mirrors, n_threads=self.n_threads, **kwargs)
+        yield from sort(mirrors, index=self.mirror_index, n_threads=self.n_threads, **kwargs)
 
     def rate(self, mirrors=None, **kwargs):
         '''
@@ -792,7 +999,6 @@ def print_mirror_info(mirrors, time_fmt=DISPLAY_TIME_FORMAT):
     Print information about each mirror to STDOUT.
     '''
     if mirrors:
-        #  mirrors = format_last_sync(mirrors)
         if not isinstance(mirrors, list):
             mirrors = list(mirrors)
         keys = sorted(k for k in mirrors[0].keys() if k != 'url')
@@ -1040,7 +1246,7 @@ def process_options(options, mirrorstatus=None, mirrors=None):
     Process options.
 
     Optionally accepts a MirrorStatus object and/or the mirrors as returned by
-    the MirrorStatus.get_mirrors method.
+    the MirrorStatus.get_mirrors or MirrorStatus.get_index methods.
     '''
     if not mirrorstatus:
         mirrorstatus = MirrorStatus(
@@ -1053,7 +1259,7 @@ def process_options(options, mirrorstatus=None, mirrors=None):
         )
 
     if mirrors is None:
-        mirrors = mirrorstatus.get_mirrors()
+        mirrors = mirrorstatus.get_index()
 
     # Filter
     mirrors = mirrorstatus.filter(
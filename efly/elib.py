@@ -1,36 +1,38 @@
-import os, subprocess, atexit, sys, re, math, pathlib
+import os, subprocess, atexit, sys, re, math, pathlib, tempfile, time
 from pathlib import Path
-import Reflector as reflector
-import distro, platformdirs
 
 __all__ = [
-    "version", "log", "info", "error", "parse_size", "r", "sudo", "chroot", "get", "du", "colored_output",
-    "pacstrap_base", "pacstrap_pkg", "reflector"
+    "version", "log", "info", "warning", "error", "parse_size", "r", "sudo", "chroot", "get", "du", "colored_output",
+    "pacstrap_base", "pacstrap_pkg", "restore_mirrorlist", "phase", "read_packages", "snapshot"
 ]
 
 version = "UNKNOWN_VERSION"
 colored_output = True
 
-# colored output, if corresponding python module is available
-try:
-    import colorama
-    from colorama import Fore, Back, Style
-    colorama.init()
-    yellow = lambda s: Fore.YELLOW + s + Style.RESET_ALL if colored_output else s
-    green = lambda s: Fore.GREEN + s + Style.RESET_ALL if colored_output else s
-    red = lambda s: Fore.RED + s + Style.RESET_ALL if colored_output else s
-    light_cyan = lambda s: Fore.LIGHTCYAN_EX + s + Style.RESET_ALL if colored_output else s
-    light_green = lambda s: Fore.LIGHTGREEN_EX + s + Style.RESET_ALL if colored_output else s
-    light_magenta = lambda s: Fore.LIGHTMAGENTA_EX + s + Style.RESET_ALL if colored_output else s
-    light_red = lambda s: Fore.LIGHTRED_EX + s + Style.RESET_ALL if colored_output else s
-except ImportError:
-    yellow = lambda s: s
-    green = lambda s: s
-    red = lambda s: s
-    light_cyan = lambda s: s
-    light_green = lambda s: s
-    light_magenta = lambda s: s
-    light_red = lambda s: s
+# colored output, if corresponding python module is available. colorama is imported on first use,
+# so that commands which print nothing colored do not pay for it.
+colorama = None
+def color(name, s):
+    global colorama
+    if not colored_output:
+        return s
+    if colorama is None:
+        try:
+            import colorama
+            colorama.init()
+        except ImportError:
+            colorama = False
+    if not colorama:
+        return s
+    return getattr(colorama.Fore, name) + s + colorama.Style.RESET_ALL
+
+yellow = lambda s: color("YELLOW", s)
+green = lambda s: color("GREEN", s)
+red = lambda s: color("RED", s)
+light_cyan = lambda s: color("LIGHTCYAN_EX", s)
+light_green = lambda s: color("LIGHTGREEN_EX", s)
+light_magenta = lambda s: color("LIGHTMAGENTA_EX", s)
+light_red = lambda s: color("LIGHTRED_EX", s)
 
 def log(prefix, msg):
     print(f"[{prefix}] {msg}")
@@ -38,6 +40,9 @@ def log(prefix, msg):
 def info(msg):
     log(yellow("info"), msg)
 
+def warning(msg):
+    log(light_magenta("warning"), msg)
+
 def error(msg):
     log(light_red("error"), msg)
 
@@ -88,10 +93,15 @@ def get_chroot_cmd():
 # instead, we use **kwargs here to define environment variables to be used inside chroot. if we were
 # to define **kwargs and pass that verbatim to python subcommand, then env would only be passed to "arch-chroot"
 # but not available inside the actual chroot (which is what we want).
+#
+# "memo" declares the inputs of a deterministic step, see memoized_step(). the step is then skipped, if
+# it ran with the same inputs before, and its changes to the target are restored from the cache.
 import atexit
 chroot_initialized = False
-def chroot(path, args, **kwargs):
+def chroot(path, args, memo=None, **kwargs):
     path = Path(path) # make sure path is an actual Path() object
+    if memo is not None and use_step_cache:
+        return memoized_step(path, args, memo, kwargs, lambda: chroot(path, args, **kwargs))
 
     global chroot_initialized
     if not chroot_initialized:
@@ -127,6 +137,95 @@ def chroot(path, args, **kwargs):
             # this should never happen since we check at program start that a command is available
             raise RuntimeError("Could not find chroot command. Either of: arch-chroot chroot")
 
+# cache of memoized chroot steps. entries are evicted, least recently used first, when the cache grows
+# beyond step_cache_max_bytes.
+use_step_cache = True
+step_cache_max_bytes = 2 * 1024**3
+
+# "name-version-pkgrel" of the given packages installed in a root filesystem
+def installed_packages(root, names):
+    installed = {}
+    for entry in (Path(root) / "var" / "lib" / "pacman" / "local").iterdir():
+        installed[entry.name.rsplit("-", 2)[0]] = entry.name
+    return [installed.get(name, f"{name} (not installed)") for name in names]
+
+# key of a memoized step: the command, its environment, the versions of the declared packages and the
+# content of the declared input files and folders of the target
+def step_key(root, args, memo, env):
+    import hashlib, json
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps([memo.get("key", [str(arg) for arg in args]), env, memo["outputs"],
+        installed_packages(root, memo.get("packages", []))]).encode())
+    inputs = [f"./{i}" for i in memo.get("inputs", []) if os.path.lexists(root / i)]
+    h.update(json.dumps([i for i in memo.get("inputs", []) if f"./{i}" not in inputs]).encode())
+    if inputs:
+        listing = get(["sudo", "find"] + inputs + ["(", "-type", "f", "-exec", "b2sum", "--", "{}", "+", ")",
+            "-o", "(", "-type", "l", "-printf", "%l  %p\\n", ")"], cwd=root)
+        h.update("\n".join(sorted(listing.splitlines())).encode())
+    return h.hexdigest()
+
+# type, inode, size, modification time, mode and owner of all files in the given folders of a root filesystem
+def tree_state(root, folders):
+    folders = [f"./{f}" for f in folders if os.path.lexists(root / f)]
+    if not folders:
+        return {}
+    output = subprocess.check_output(["sudo", "find"] + folders + ["-printf", "%p\\0%y %i %s %T@ %m %U %G\\0"], cwd=root)
+    fields = output.decode("utf-8", "surrogateescape").split("\0")
+    return dict(zip(fields[0:-1:2], fields[1::2]))
+
+# run a deterministic chroot step or restore its result from the cache. "memo" is a dict of:
+#   outputs:  folders of the target, relative to its root, which the step changes. required.
+#   inputs:   files and folders of the target that the step reads.
+#   packages: installed packages of the target that the step depends on.
+#   key:      strings that identify the command, instead of its arguments. e.g. for arguments that
+#             change with every build, but do not affect the result.
+# the changes of the step are the files in the output folders that are new or changed afterwards, plus
+# the deleted ones. they are stored as compressed tarball.
+def memoized_step(root, args, memo, env, run):
+    import json, shutil
+    cache = get_cache_dir() / "steps"
+    entry = cache / step_key(root, args, memo, env)
+    if (entry / "step.json").is_file():
+        step = json.loads((entry / "step.json").read_text(encoding="utf-8"))
+        count_cache("steps", True)
+        info(f"restoring cached result of: {' '.join(str(arg) for arg in args)}")
+        for path in reversed(step["deleted"]):
+            sudo(["rm", "--recursive", "--force", root / path])
+        sudo(["tar", "--extract", "--zstd", "--numeric-owner", "--xattrs", "--xattrs-include=*", "--directory", root, "--file", entry / "delta.tar.zst"])
+        os.utime(entry)
+        return 0
+
+    count_cache("steps", False)
+    before = tree_state(root, memo["outputs"])
+    returncode = run()
+    after = tree_state(root, memo["outputs"])
+    changed = [path for path, state in after.items() if before.get(path) != state]
+    deleted = [path for path in before if path not in after]
+
+    staging = entry.with_name(entry.name + ".new")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    # only the listed files, not the content of changed folders
+    sudo(["tar", "--create", "--zstd", "--no-recursion", "--numeric-owner", "--xattrs", "--xattrs-include=*", "--directory", root,
+        "--null", "--files-from", "-", "--file", staging / "delta.tar.zst"], input="\0".join(changed).encode("utf-8", "surrogateescape"))
+    sudo(["chown", f"{os.getuid()}:{os.getgid()}", staging / "delta.tar.zst"])
+    (staging / "step.json").write_text(json.dumps({"command": [str(arg) for arg in args], "changed": len(changed),
+        "deleted": deleted}, indent=2) + "\n", encoding="utf-8")
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(staging, entry)
+    evict_steps(cache)
+    return returncode
+
+# delete the least recently used steps until the cache fits into step_cache_max_bytes
+def evict_steps(cache):
+    import shutil
+    entries = sorted((e for e in cache.iterdir() if (e / "step.json").is_file()), key=lambda e: e.stat().st_mtime, reverse=True)
+    total = 0
+    for entry in entries:
+        total += sum(f.stat().st_size for f in entry.iterdir())
+        if total > step_cache_max_bytes:
+            shutil.rmtree(entry)
+
 def get(args, **kwargs):
     log(light_cyan("get"), ' '.join(str(arg) for arg in args))
     return subprocess.check_output(args, **kwargs).decode('utf-8').rstrip()
@@ -135,9 +234,133 @@ def get(args, **kwargs):
 def du(path, **kwargs):
     return int(get(['sudo', 'du','--summarize', '--bytes', path], **kwargs).split()[0])
 
+# wall clock time of the phases of a build. phase() ends the current phase and starts the next one.
+phases = []
+def phase(name):
+    now = time.monotonic()
+    if phases:
+        phases[-1]["seconds"] = now - phases[-1]["start"]
+    phases.append({"name": name, "start": now})
+
+# write the phase timings and the peak memory usage as json. the peak of the child processes is the
+# largest resident set size of any single (terminated) child process.
+def write_timings(path):
+    import json, resource
+    phase("exit")
+    phases.pop()
+    Path(path).write_text(json.dumps({
+        "phases": [{"name": p["name"], "seconds": p["seconds"]} for p in phases],
+        "total_seconds": sum(p["seconds"] for p in phases),
+        "peak_rss_self_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_rss_children_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }, indent=2) + "\n", encoding="utf-8")
+
+# byte counts and cache statistics of a build, written by write_metrics(). the pacman cache proxy keeps
+# its own statistics, which are added when writing.
+metrics = {"downloads": [], "caches": {}, "reflector": None, "partitions": {}, "image": {}}
+
+def count_cache(name, hit):
+    stats = metrics["caches"].setdefault(name, {"hits": 0, "misses": 0})
+    stats["hits" if hit else "misses"] += 1
+
+# bytes written to a partition since its loop device was set up, as counted by the kernel, the size of the
+# partition and the space used by its filesystem. run sync before, so that no writes are pending.
+def record_partition(name, device, mountpoint):
+    block = Path("/sys/class/block") / Path(os.path.realpath(device)).name
+    sectors_written = int((block / "stat").read_text().split()[6])
+    fs = os.statvfs(mountpoint)
+    metrics["partitions"][name] = {
+        "written_bytes": sectors_written * 512,
+        "size_bytes": int((block / "size").read_text()) * 512,
+        "filesystem_bytes": fs.f_blocks * fs.f_frsize,
+        "used_bytes": (fs.f_blocks - fs.f_bfree) * fs.f_frsize,
+    }
+
+# size of the image and the space actually allocated for it. a sparse image file only allocates the
+# blocks that were written. for block devices, the allocated size is the size.
+def record_image(path):
+    st = os.stat(path)
+    size = st.st_size if Path(path).is_file() else int(get(["sudo", "blockdev", "--getsize64", path]))
+    metrics["image"] = {
+        "size_bytes": size,
+        "allocated_bytes": st.st_blocks * 512 if Path(path).is_file() else size,
+        "used_bytes": sum(p["used_bytes"] for p in metrics["partitions"].values()),
+    }
+
+# the metrics as prometheus text format, for the textfile collector of the node exporter
+def prometheus_metrics(report):
+    samples = {}
+    def add(name, help, value, **labels):
+        if value is None:
+            return
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        label_text = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+        samples.setdefault((name, help), []).append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+
+    add("efly_build_timestamp_seconds", "Time the build finished.", report["timestamp"])
+    for d in report["downloads"]:
+        labels = {"source": d["source"], "mirror": d["mirror"]} if d["mirror"] else {"source": d["source"]}
+        add("efly_download_bytes", "Bytes downloaded, by source and mirror.", d["bytes"], **labels)
+        add("efly_download_seconds", "Time spent downloading, by source and mirror.", d["seconds"], **labels)
+    for cache, c in report["caches"].items():
+        add("efly_cache_hits", "Cache hits, by cache.", c["hits"], cache=cache)
+        add("efly_cache_misses", "Cache misses, by cache.", c["misses"], cache=cache)
+        add("efly_cache_hit_ratio", "Hits per lookup, by cache.", c["hit_ratio"], cache=cache)
+    if report["reflector"]:
+        add("efly_mirrorlist_age_seconds", "Age of the rated mirror list.", report["reflector"]["age_seconds"])
+        for m in report["reflector"]["mirrors"]:
+            add("efly_mirror_rate_bytes_per_second", "Download rate measured by reflector, by mirror.", m["bytes_per_second"], mirror=m["url"])
+    partition_help = {
+        "written_bytes": "Bytes written to the partition during the build.",
+        "size_bytes": "Size of the partition.",
+        "filesystem_bytes": "Size of the filesystem of the partition.",
+        "used_bytes": "Used space of the filesystem of the partition.",
+    }
+    for partition, p in report["partitions"].items():
+        for key, value in p.items():
+            add(f"efly_partition_{key}", partition_help[key], value, partition=partition)
+    image_help = {
+        "size_bytes": "Size of the image.",
+        "allocated_bytes": "Space allocated for the image. Less than its size for sparse image files.",
+        "used_bytes": "Used space of the filesystems of the image.",
+    }
+    for key, value in report["image"].items():
+        add(f"efly_image_{key}", image_help[key], value)
+    return "".join(f"# HELP {name} {help}\n# TYPE {name} gauge\n" + "\n".join(lines) + "\n" for (name, help), lines in samples.items())
+
+# write the metrics of the build as json and in prometheus text format. missing values, like the partitions
+# of a failed build, are left out.
+def write_metrics(path=None, prom_path=None):
+    import json
+    downloads = list(metrics["downloads"])
+    caches = {name: dict(c) for name, c in metrics["caches"].items()}
+    if proxy is not None:
+        for mirror, kinds in proxy.stats["mirrors"].items():
+            for kind, d in kinds.items():
+                downloads.append({"source": kind, "mirror": mirror, "bytes": d["bytes"], "seconds": d["seconds"]})
+        for kind in ("db", "pkg"):
+            caches[f"proxy-{kind}"] = {"hits": proxy.stats[kind]["hits"], "misses": proxy.stats[kind]["misses"]}
+    for c in caches.values():
+        c["hit_ratio"] = c["hits"] / (c["hits"] + c["misses"]) if c["hits"] + c["misses"] else None
+    report = {
+        "timestamp": time.time(),
+        "downloads": downloads,
+        "caches": caches,
+        "reflector": metrics["reflector"],
+        "partitions": metrics["partitions"],
+        "image": metrics["image"],
+    }
+    if path:
+        Path(path).write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+    if prom_path:
+        # the textfile collector may read at any time. replace the file at once.
+        tmp = Path(prom_path).with_name(Path(prom_path).name + ".tmp")
+        tmp.write_text(prometheus_metrics(report), encoding="utf-8")
+        os.replace(tmp, prom_path)
+
 # https://stackoverflow.com/questions/15644964/python-progress-bar-and-downloads
-import requests, tqdm
 def download(url: str, dest: pathlib.Path, chunk_size=1024):
+    import requests, tqdm
     resp = requests.get(url, stream=True)
     total = int(resp.headers.get('content-length', 0))
     with dest.open('wb') as file, tqdm.tqdm(
@@ -150,12 +373,16 @@ def download(url: str, dest: pathlib.Path, chunk_size=1024):
         for data in resp.iter_content(chunk_size=chunk_size):
             size = file.write(data)
             bar.update(size)
+    return dest.stat().st_size
 
-import hashlib
+# download a file, unless it is in the cache already, and check its checksum. returns the number of
+# downloaded bytes.
 def hash_download(url: str, dest: pathlib.Path, b2sum: str=None):
+    import hashlib
     dest.parent.mkdir(parents=True, exist_ok=True)
+    downloaded = 0
     if not dest.exists():
-        download(url=url, dest=dest)
+        downloaded = download(url=url, dest=dest)
     if b2sum:
         with open(dest, "rb") as f:
             b2sum_digest = hashlib.file_digest(f, "blake2b").hexdigest()
@@ -166,44 +393,356 @@ def hash_download(url: str, dest: pathlib.Path, b2sum: str=None):
                 raise RuntimeError("checksum fail")
             else:
                 info("checksum: OK")
+    return downloaded
+
+# cache and data folders. platformdirs is only imported by the commands that need them.
+def get_cache_dir():
+    import platformdirs
+    return pathlib.Path(platformdirs.user_cache_dir("efly")) / "dd"
+
+# chunk store of "efly store"
+def get_store_dir():
+    import platformdirs
+    return pathlib.Path(platformdirs.user_data_dir("efly")) / "store"
 
-cache_dir = pathlib.Path(platformdirs.user_cache_dir("efly")) / "dd"
 boot_version = "2024.05.01"
-bootstrap_dir = cache_dir / f"archlinux-bootstrap-{boot_version}" / "root.x86_64"
+# extracted bootstrap system, set by get_bootstrap()
+bootstrap_dir = None
+
+# the host runs arch linux and has pacstrap itself, no bootstrap system needed
+def host_is_arch():
+    import distro
+    return distro.id() == "arch"
+
+# write a file owned by root
+def sudo_write(path, text):
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="efly-") as handle:
+        handle.write(text)
+        handle.flush()
+        sudo(["cp", handle.name, path])
+    sudo(["chown", "root:root", path])
+    sudo(["chmod", "644", path])
+
+# pacman mirror list rated by reflector. the result is cached for a day, together with the measured
+# download rates of the mirrors.
+mirrorlist_max_age = 24 * 60 * 60
+def rated_mirrorlist():
+    import json
+    path = get_cache_dir() / "mirrorlist"
+    rates_path = path.with_name("mirrorlist.rates.json")
+    if not path.is_file() or time.time() - path.stat().st_mtime > mirrorlist_max_age:
+        import Reflector as reflector
+        mirrorlist = reflector.get_mirrors(latest=10, sort="rate")
+        print(mirrorlist)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(mirrorlist, encoding="utf-8")
+        rates_path.write_text(json.dumps(reflector.last_rates, indent=2) + "\n", encoding="utf-8")
+
+    import pkgproxy
+    mirrorlist = path.read_text(encoding="utf-8")
+    rates = json.loads(rates_path.read_text(encoding="utf-8")) if rates_path.is_file() else {}
+    metrics["reflector"] = {
+        "age_seconds": time.time() - path.stat().st_mtime,
+        "mirrors": [{"url": url, "bytes_per_second": rates.get(url)} for url in pkgproxy.parse_mirrorlist(mirrorlist)],
+    }
+    return mirrorlist
+
+# local caching proxy for all pacman downloads of a build. set to False to download directly from the mirrors.
+use_proxy = True
+proxy = None
+def get_proxy():
+    global proxy
+    if proxy is None:
+        import pkgproxy
+        proxy = pkgproxy.PackageProxy(get_cache_dir() / "pkg", pkgproxy.parse_mirrorlist(rated_mirrorlist()))
+        proxy.start()
+        atexit.register(proxy.stop)
+        atexit.register(lambda: info(f"pacman cache proxy: {proxy.stats['db']['hits'] + proxy.stats['pkg']['hits']} hits, "
+            f"{proxy.stats['db']['misses'] + proxy.stats['pkg']['misses']} misses, {len(proxy.snapshot)} databases"))
+        info(f"pacman cache proxy: {proxy.url}")
+    return proxy
+
+# pacman config that downloads everything through the proxy. it is a copy of the given pacman.conf
+# with the mirror list includes replaced by the proxy.
+def proxy_conf(pacman_conf):
+    conf = Path(pacman_conf).read_text(encoding="utf-8")
+    server = get_proxy().mirrorlist().splitlines()[-1]
+    return re.sub(r'^\s*Include\s*=\s*/etc/pacman\.d/mirrorlist\s*$', server, conf, flags=re.MULTILINE)
+
+# custom pacman config for all downloads of a build, e.g. for a local repository. replaces the
+# mirror list and the proxy.
+pacman_conf = None
+
+# local repository directory (repo database plus package files) for offline builds. see "efly snapshot".
+local_repo = None
+
+# path at which the local repository is bind-mounted into the bootstrap system and into the image
+local_repo_mount = Path("/var/cache/efly-repo")
+
+# make a local repository available inside another root filesystem
+local_repo_mounted = set()
+def mount_local_repo(root, repo_dir, read_only=True):
+    target = Path(root) / local_repo_mount.relative_to("/")
+    if target not in local_repo_mounted:
+        sudo(["mkdir", "--parents", target])
+        atexit.register(sudo, ["rmdir", target], ignore_error=True)
+        sudo(["mount", "--bind"] + (["-o", "ro"] if read_only else []) + [repo_dir, target])
+        atexit.register(sudo, ["umount", "--lazy", target])
+        local_repo_mounted.add(target)
+    return local_repo_mount
+
+# names of the repositories in a local repository directory. e.g. "efly" for "efly.db".
+def local_repo_names(repo_dir):
+    return sorted(db.name.removesuffix(".db") for db in Path(repo_dir).glob("*.db"))
+
+# pacman config that installs only from the local repository found at the given path. signatures are
+# verified, if the repository database contains them.
+def local_repo_conf(repo_dir):
+    conf = "[options]\nArchitecture = auto\nSigLevel = Optional TrustedOnly\n"
+    for name in local_repo_names(local_repo):
+        conf += f"\n[{name}]\nServer = file://{repo_dir}\n"
+    return conf
+
+# content of the pacman config used for downloads by the given root (None is the host system)
+def build_conf(root=None):
+    if local_repo:
+        return local_repo_conf(Path(local_repo).resolve() if root is None else mount_local_repo(root, local_repo))
+    if pacman_conf:
+        return Path(pacman_conf).read_text(encoding="utf-8")
+    return proxy_conf(Path(root or "/") / "etc" / "pacman.conf")
+
+# path of the pacman config used for downloads: the local repository, the custom config or a copy of the
+# system's config that downloads through the proxy. "root" is the system that runs pacman or None for
+# the host system. the returned path is relative to that system.
+pacman_conf_paths = {}
+def pacman_conf_path(root=None):
+    if root not in pacman_conf_paths:
+        if root is None:
+            handle, path = tempfile.mkstemp(prefix="efly-pacman-", suffix=".conf")
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                file.write(build_conf())
+            atexit.register(os.remove, path)
+            pacman_conf_paths[root] = Path(path)
+        else:
+            path = Path(root) / "etc" / "pacman.efly.conf"
+            sudo_write(path, build_conf(root))
+            atexit.register(sudo, ["rm", "--force", path], ignore_error=True)
+            pacman_conf_paths[root] = Path("/") / path.relative_to(root)
+    return pacman_conf_paths[root]
+
+# true, if downloads do not use the mirror list of the system running pacman
+def custom_downloads():
+    return bool(local_repo or pacman_conf or use_proxy)
+
+# pacstrap options to download through the local repository, the custom config or the proxy, if enabled
+def pacstrap_args(root=None):
+    return ["-C", pacman_conf_path(root)] if custom_downloads() else []
+
+# point the mirror list of an installed system to the proxy. restore_mirrorlist() undoes this.
+def use_proxy_mirrorlist(root):
+    mirrorlist = Path(root) / "etc" / "pacman.d" / "mirrorlist"
+    sudo(["mv", mirrorlist, mirrorlist.with_name("mirrorlist.efly-orig")])
+    sudo_write(mirrorlist, get_proxy().mirrorlist())
+
+def restore_mirrorlist(root):
+    mirrorlist = Path(root) / "etc" / "pacman.d" / "mirrorlist"
+    if mirrorlist.with_name("mirrorlist.efly-orig").exists():
+        sudo(["mv", mirrorlist.with_name("mirrorlist.efly-orig"), mirrorlist])
+
+# bootstrap archive (tarball) or already extracted bootstrap root folder to use instead of downloading
+# the archlinux bootstrap tarball.
+bootstrap_archive = None
+
+# return an arch linux system for running pacstrap on other distributions. the bootstrap tarball is
+# downloaded and extracted on first use.
+def get_bootstrap():
+    global bootstrap_dir
+
+    if bootstrap_archive and Path(bootstrap_archive).is_dir():
+        bootstrap_dir = Path(bootstrap_archive).resolve()
+        if not (bootstrap_dir / "etc" / "pacman.d" / "gnupg").is_dir():
+            sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman-key", "--init"])
+            sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman-key", "--populate"])
+        return bootstrap_dir
 
-# only install the base system
-def pacstrap_base(chroot_fs, tmp):
-    if distro.id() == "arch":
-        sudo(["pacstrap", "-c", chroot_fs])
+    if bootstrap_archive:
+        dest = Path(bootstrap_archive).resolve()
+        bootstrap_dir = get_cache_dir() / dest.name.split(".tar")[0] / "root.x86_64"
     else:
         # download bootstrap tarball
-        dest = cache_dir / f"archlinux-bootstrap-{boot_version}-x86_64.tar.zst"
-        hash_download(
-            url = f"https://ftp.snt.utwente.nl/pub/os/linux/archlinux/iso/{boot_version}/archlinux-bootstrap-{boot_version}-x86_64.tar.zst",
+        bootstrap_dir = get_cache_dir() / f"archlinux-bootstrap-{boot_version}" / "root.x86_64"
+        dest = get_cache_dir() / f"archlinux-bootstrap-{boot_version}-x86_64.tar.zst"
+        url = f"https://ftp.snt.utwente.nl/pub/os/linux/archlinux/iso/{boot_version}/archlinux-bootstrap-{boot_version}-x86_64.tar.zst"
+        start = time.monotonic()
+        downloaded = hash_download(
+            url = url,
             dest = dest,
             b2sum = "fbc9f2e9bdadae804901ff63bbf6ba7d98ce95e98ea37e9d3f5de1fc0fbefdf0714c0d75a6f05aad4c45f85aa4cc27dad1d9b1c817c93c96e8c60f62659d82bb"
         )
+        metrics["downloads"].append({"source": "bootstrap", "mirror": url.split("/")[2], "bytes": downloaded, "seconds": time.monotonic() - start})
+        count_cache("bootstrap", not downloaded)
+
+    # unpack the archive
+    if not bootstrap_dir.exists():
+        # bootstrap an arch system inside .cache folder
+        bootstrap_dir.parent.mkdir(parents=True)
+        sudo(["tar", "-C", bootstrap_dir.parent, "--numeric-owner", "--xattrs", "--xattrs-include='*'", "-xpf", dest])
+
+        # obtain pacman mirror list. not needed, if all downloads go to a local repository or a custom pacman config.
+        if not local_repo and not pacman_conf:
+            sudo_write(bootstrap_dir / "etc" / "pacman.d" / "mirrorlist", rated_mirrorlist())
+
+        # init pacman keyring and update packages. the databases are not force-refreshed, so that they are
+        # only downloaded, if the proxy or the mirror has newer ones. see pkgproxy.py.
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman-key", "--init"])
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman-key", "--populate"])
+        pacman_args = ["--config", pacman_conf_path(bootstrap_dir)] if custom_downloads() else []
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman", "--sync", "--refresh", "--sysupgrade", "--sysupgrade", "--noconfirm"] + pacman_args)
+
+    return bootstrap_dir
+
+# expensive pacman hooks that only regenerate caches and images from the installed files. during a build,
+# they are disabled in every package transaction and run once at the end, see run_deferred_hooks().
+# each hook lists the hooks that have to run before it. the others run in parallel.
+# systemd-sysusers and systemd-tmpfiles are not deferred: install scripts of later transactions may need
+# their users and folders. ldconfig is run by pacman itself, not by a hook.
+defer_hooks = True
+deferred_hooks = {
+    "90-mkinitcpio-install": [],
+    "40-fontconfig-config": [],
+    "fontconfig": ["40-fontconfig-config"],
+    "gdk-pixbuf-query-loaders": [],
+    "gtk-update-icon-cache": ["gdk-pixbuf-query-loaders"],
+    "gtk-query-immodules-3.0": [],
+    "gtk-query-immodules-2.0": [],
+    "update-desktop-database": [],
+    "update-mime-database": [],
+    "glib-compile-schemas": [],
+    "gio-querymodules": [],
+    "texinfo-install": [],
+}
+
+# disable the deferred hooks in the root filesystem of the image, by overriding them with a symlink to
+# /dev/null in its hook folder. pacstrap runs pacman with the hook folder of the host, so it gets the
+# hook folder of the image passed explicitly (see hook_args()).
+def disable_deferred_hooks(root):
+    hooks = Path(root) / "etc" / "pacman.d" / "hooks"
+    sudo(["mkdir", "--parents", hooks])
+    for name in deferred_hooks:
+        sudo(["ln", "--symbolic", "--force", "/dev/null", hooks / f"{name}.hook"])
+
+# pacman options for pacstrap, which installs into the image at the given path
+def hook_args(path):
+    return ["--hookdir", Path(path) / "etc" / "pacman.d" / "hooks"] if defer_hooks else []
+
+# parse a pacman hook file (see "man alpm-hooks") into its triggers and action
+def parse_hook(text):
+    triggers, action, section = [], {"NeedsTargets": False}, None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("["):
+            section = line.strip("[]")
+            if section == "Trigger":
+                triggers.append({"Operation": [], "Target": []})
+            continue
+        key, _, value = (part.strip() for part in line.partition("="))
+        if section == "Trigger":
+            if key in ("Operation", "Target"):
+                triggers[-1][key].append(value)
+            else:
+                triggers[-1][key] = value
+        elif key == "NeedsTargets":
+            action[key] = True
+        else:
+            action[key] = value
+    return triggers, action
+
+# match a target against the patterns of a trigger like pacman does: the last matching pattern decides,
+# patterns starting with "!" exclude.
+def match_targets(patterns, target):
+    import fnmatch
+    for pattern in reversed(patterns):
+        if fnmatch.fnmatchcase(target, pattern.removeprefix("!")):
+            return not pattern.startswith("!")
+    return False
+
+# installed packages of a root filesystem and their files
+def installed_files(root):
+    packages = {}
+    for entry in (Path(root) / "var" / "lib" / "pacman" / "local").iterdir():
+        files_list = entry / "files"
+        if not files_list.is_file():
+            continue
+        lines = files_list.read_text(encoding="utf-8").splitlines()
+        files = lines[lines.index("%FILES%") + 1:] if "%FILES%" in lines else []
+        packages[entry.name.rsplit("-", 2)[0]] = [f for f in files if f and not f.startswith("%")]
+    return packages
+
+# enable the deferred hooks again and run each one, whose triggers match the packages installed during
+# the build, exactly once. since every package of the image was installed during the build, a trigger
+# matches, if it matches any installed package or file. hooks run in parallel, as far as their order
+# allows. like pacman, a failing hook is reported but does not stop the build.
+def run_deferred_hooks(root):
+    import shlex
+    root = Path(root)
+    hooks_dir = root / "etc" / "pacman.d" / "hooks"
+    for name in deferred_hooks:
+        if (hooks_dir / f"{name}.hook").is_symlink() and os.readlink(hooks_dir / f"{name}.hook") == "/dev/null":
+            sudo(["rm", hooks_dir / f"{name}.hook"])
+
+    packages = installed_files(root)
+    files = [f for package_files in packages.values() for f in package_files]
+    triggered = {}
+    for name in deferred_hooks:
+        path = next((d / f"{name}.hook" for d in [hooks_dir, root / "usr" / "share" / "libalpm" / "hooks"] if (d / f"{name}.hook").is_file()), None)
+        if path is None:
+            continue
+        triggers, action = parse_hook(path.read_text(encoding="utf-8"))
+        if action.get("When") != "PostTransaction" or "Exec" not in action:
+            continue
+        targets = set()
+        for trigger in triggers:
+            if not {"Install", "Upgrade"} & set(trigger["Operation"]):
+                continue
+            candidates = packages.keys() if trigger.get("Type") == "Package" else files
+            targets.update(c for c in candidates if match_targets(trigger["Target"], c))
+        if targets:
+            triggered[name] = (action, sorted(targets))
+    if not triggered:
+        return
+    info(f"running deferred pacman hooks: {' '.join(triggered)}")
+
+    # one shell script starts the hooks in waves, so that all of them run inside a single chroot
+    work = Path("/var/tmp/efly-hooks")
+    sudo(["mkdir", "--parents", root / work.relative_to("/")])
+    script = "#!/bin/sh\ncd /\n"
+    done = set()
+    while len(done) < len(triggered):
+        wave = [n for n in triggered if n not in done and all(d in done or d not in triggered for d in deferred_hooks[n])]
+        for name in wave:
+            action, targets = triggered[name]
+            stdin = "/dev/null"
+            if action["NeedsTargets"]:
+                stdin = work / f"{name}.targets"
+                sudo_write(root / stdin.relative_to("/"), "\n".join(targets) + "\n")
+            script += f"({action['Exec']}) < {stdin} &\npid_{wave.index(name)}=$!\n"
+        for i, name in enumerate(wave):
+            script += f"wait $pid_{i} || echo {shlex.quote(f'error: deferred hook {name} failed')}\n"
+        done.update(wave)
+    sudo_write(root / work.relative_to("/") / "run", script)
+    chroot(root, ["/bin/sh", work / "run"])
+    sudo(["rm", "--recursive", root / work.relative_to("/")])
 
-        # unpack the archive
-        if not bootstrap_dir.exists():
-            # bootstrap an arch system inside .cache folder
-            os.mkdir(bootstrap_dir.parent)
-            sudo(["tar", "-C", bootstrap_dir.parent, "--numeric-owner", "--xattrs", "--xattrs-include='*'", "-xpf", dest])
-
-            # obtain pacman mirror list
-            mirrorlist = reflector.get_mirrors(latest=10, sort="rate")
-            print(mirrorlist)
-            with open(cache_dir / "mirrorlist", 'w', encoding='utf-8') as handle:
-                handle.write(mirrorlist)
-
-            # move mirror list to the correct location
-            sudo(["mv", cache_dir / "mirrorlist", bootstrap_dir / "etc" / "pacman.d"])
-            sudo(["chown", "root:root", bootstrap_dir / "etc" / "pacman.d" / "mirrorlist"])
-
-            # init pacman keyring and update packages
-            sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman-key", "--init"])
-            sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman-key", "--populate"])
-            sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacman", "--sync", "--refresh", "--refresh", "--sysupgrade", "--sysupgrade", "--noconfirm"])
+# only install the base system
+def pacstrap_base(chroot_fs, tmp):
+    if defer_hooks:
+        disable_deferred_hooks(chroot_fs)
+    if host_is_arch():
+        sudo(["pacstrap"] + pacstrap_args() + ["-c", chroot_fs] + (["base"] + hook_args(chroot_fs) if defer_hooks else []))
+    else:
+        bootstrap_dir = get_bootstrap()
 
         # bind-mount image partitions into bootstrapped arch
         sudo(["mkdir", "--parents", bootstrap_dir / tmp.name])
@@ -212,13 +751,61 @@ def pacstrap_base(chroot_fs, tmp):
         atexit.register(sudo, ["umount", "--lazy", bootstrap_dir / tmp.name])
 
         # finally run pacstrap to init arch inside the image
-        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacstrap", "-c", tmp.name])
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacstrap"] + pacstrap_args(bootstrap_dir) + ["-c", tmp.name]
+            + (["base"] + hook_args(Path("/") / tmp.name) if defer_hooks else []))
 
 # install user-defined packages
 def pacstrap_pkg(chroot_fs, packages, tmp):
-    if distro.id() == "arch":
-        sudo(["pacstrap", "-c", chroot_fs] + packages)
+    if host_is_arch():
+        sudo(["pacstrap"] + pacstrap_args() + ["-c", chroot_fs] + packages + hook_args(chroot_fs))
+    else:
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacstrap"] + pacstrap_args(bootstrap_dir) + ["-c", tmp.name] + packages
+            + hook_args(Path("/") / tmp.name))
+
+    # the installed system downloads through the proxy as well, until restore_mirrorlist() is called.
+    # pacstrap got the databases of this build already, so the proxy answers the refresh with "not modified".
+    pacman_args = []
+    if local_repo or pacman_conf:
+        pacman_args = ["--config", pacman_conf_path(chroot_fs)]
+    elif use_proxy:
+        use_proxy_mirrorlist(chroot_fs)
+    chroot(chroot_fs, ["pacman", "--sync", "--refresh", "--sysupgrade", "--sysupgrade", "--noconfirm"] + pacman_args)
+
+# read a packages.txt file of a profile. comments start with "#". several packages may share a line.
+def read_packages(package_txt):
+    packages = []
+    with open(package_txt) as lines:
+        for line in lines:
+            line = line.split('#')[0]
+            for pkg in line.split():
+                packages.append(pkg)
+    return packages
+
+# download the given packages and all their dependencies into a local repository directory named "efly"
+# for offline builds. the "base" package, which pacstrap installs by default, is always included.
+def snapshot(repo_dir, packages):
+    repo_dir = Path(repo_dir).resolve()
+    repo_dir.mkdir(parents=True, exist_ok=True)
+    packages = ["base"] + [p for p in packages if p != "base"]
+
+    # an empty package database makes pacman download the complete dependency tree
+    if host_is_arch():
+        dbpath = Path(tempfile.mkdtemp(prefix="efly-snapshot-db-"))
+        atexit.register(sudo, ["rm", "--recursive", "--force", dbpath])
+        pacman = ["pacman", "--dbpath", dbpath, "--cachedir", repo_dir] + (["--config", pacman_conf_path()] if use_proxy else [])
+        sudo(pacman + ["--sync", "--refresh", "--downloadonly", "--noconfirm"] + packages)
+        # only add the current versions. older versions of the packages are still in the folder, if the snapshot
+        # is updated. --remove replaces their database entries and deletes their files.
+        files = get(["sudo"] + pacman + ["--sync", "--print", "--print-format", "%f", "--noconfirm"] + packages).split()
+        sudo(["repo-add", "--remove", repo_dir / "efly.db.tar.zst"] + [repo_dir / f for f in files])
     else:
-        bootstrap_dir = cache_dir / f"archlinux-bootstrap-{boot_version}" / "root.x86_64"
-        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacstrap", "-c", tmp.name] + packages)
-    chroot(chroot_fs, ["pacman", "--sync", "--refresh", "--refresh", "--sysupgrade", "--sysupgrade", "--noconfirm"])
+        bootstrap_dir = get_bootstrap()
+        target = mount_local_repo(bootstrap_dir, repo_dir, read_only=False)
+        dbpath = "/tmp/efly-snapshot-db"
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "mkdir", "--parents", dbpath])
+        atexit.register(sudo, ["rm", "--recursive", "--force", bootstrap_dir / dbpath.lstrip("/")], ignore_error=True)
+        pacman = ["systemd-nspawn", "-qD", bootstrap_dir, "pacman", "--dbpath", dbpath, "--cachedir", target] \
+            + (["--config", pacman_conf_path(bootstrap_dir)] if use_proxy else [])
+        sudo(pacman + ["--sync", "--refresh", "--downloadonly", "--noconfirm"] + packages)
+        files = get(["sudo"] + pacman + ["--sync", "--print", "--print-format", "%f", "--noconfirm"] + packages).split()
+        sudo(["systemd-nspawn", "-qD", bootstrap_dir, "repo-add", "--remove", target / "efly.db.tar.zst"] + [target / f for f in files])
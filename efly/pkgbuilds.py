@@ -0,0 +1,254 @@
+# builds the PKGBUILDs of a profile (the "pkgbuilds" folder, one subfolder per PKGBUILD) for efly-dd.
+#
+# every package is built in a clean container: an overlay on top of a build root, which is an arch
+# system with base-devel kept in the efly cache. build dependencies are installed into the overlay and
+# thrown away with it, so they never reach the image. independent PKGBUILDs are built in parallel.
+#
+# built packages are cached by a hash of the PKGBUILD folder (PKGBUILD, patches and other local sources;
+# remote sources are pinned by the checksums in the PKGBUILD), the packages of the build root and the
+# hashes of the PKGBUILDs it depends on. an unchanged PKGBUILD is never built again.
+
+import concurrent.futures, hashlib, os, re, shutil, subprocess
+from pathlib import Path
+
+import elib
+from elib import *
+
+# files left behind by running makepkg in a PKGBUILD folder. they are not part of the cache key.
+build_artifacts = re.compile(r'^(src|pkg)$|\.pkg\.tar(\.\w+)?(\.sig)?$|\.log$')
+
+# variables of a PKGBUILD needed for scheduling the builds
+pkgbuild_vars = ["pkgname", "pkgver", "pkgrel", "epoch", "depends", "depends_x86_64", "makedepends",
+    "makedepends_x86_64", "checkdepends", "provides"]
+
+# read the variables of a PKGBUILD by sourcing it with bash, like makepkg does
+def read_pkgbuild(path):
+    script = 'source ./PKGBUILD >/dev/null || exit 1; for v in "$@"; do declare -n a=$v; for x in "${a[@]}"; do printf "%s\\t%s\\n" "$v" "$x"; done; done'
+    try:
+        output = subprocess.check_output(["bash", "-c", script, "bash"] + pkgbuild_vars, cwd=path, text=True)
+    except subprocess.CalledProcessError:
+        error(f"could not read PKGBUILD of {Path(path).name}")
+        exit(1)
+    pkgbuild = {"name": Path(path).name, "path": Path(path).resolve()}
+    pkgbuild.update({v: [] for v in pkgbuild_vars})
+    for line in output.splitlines():
+        key, _, value = line.partition("\t")
+        pkgbuild[key].append(value)
+    return pkgbuild
+
+# package name of a dependency like "go>=1.19"
+def dep_name(dep):
+    return re.split(r'[<>=]', dep)[0]
+
+# all PKGBUILD folders of a profile
+def read_profile(profile):
+    folder = Path(profile) / "pkgbuilds"
+    if not folder.is_dir():
+        return []
+    return [read_pkgbuild(p) for p in sorted(folder.iterdir()) if (p / "PKGBUILD").is_file()]
+
+# dependencies of a PKGBUILD that are built from another PKGBUILD of the same profile
+def local_deps(pkgbuild, pkgbuilds):
+    provided = {dep_name(p): other["name"] for other in pkgbuilds for p in other["pkgname"] + other["provides"]}
+    deps = pkgbuild["depends"] + pkgbuild["depends_x86_64"] + pkgbuild["makedepends"] + pkgbuild["makedepends_x86_64"] + pkgbuild["checkdepends"]
+    return sorted({provided[dep_name(d)] for d in deps if dep_name(d) in provided} - {pkgbuild["name"]})
+
+# dependencies of the PKGBUILDs that come from the repositories. "efly snapshot" adds them to a local
+# repository, so that offline builds can build the PKGBUILDs as well.
+def repo_deps(pkgbuilds):
+    if not pkgbuilds:
+        return []
+    provided = {dep_name(p) for pkgbuild in pkgbuilds for p in pkgbuild["pkgname"] + pkgbuild["provides"]}
+    deps = [dep_name(d) for pkgbuild in pkgbuilds for key in ["depends", "depends_x86_64", "makedepends", "makedepends_x86_64", "checkdepends"] for d in pkgbuild[key]]
+    return ["base-devel"] + sorted({d for d in deps if d not in provided})
+
+# sort PKGBUILDs so that each comes after the ones it depends on
+def build_order(pkgbuilds):
+    by_name = {p["name"]: p for p in pkgbuilds}
+    order, visiting = [], set()
+    def visit(name):
+        if name in visiting:
+            raise RuntimeError(f"dependency cycle between PKGBUILDs: {name}")
+        if by_name[name] in order:
+            return
+        visiting.add(name)
+        for dep in local_deps(by_name[name], pkgbuilds):
+            visit(dep)
+        visiting.remove(name)
+        order.append(by_name[name])
+    for name in by_name:
+        visit(name)
+    return order
+
+def pkgbuild_hash(pkgbuild, toolchain, dep_keys):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(toolchain.encode())
+    for key in dep_keys:
+        h.update(key.encode())
+    root = pkgbuild["path"]
+    for path in sorted(root.rglob("*")):
+        relative = path.relative_to(root)
+        if any(build_artifacts.search(part) for part in relative.parts) or not path.is_file():
+            continue
+        data = path.read_bytes()
+        h.update(f"{relative}\0{len(data)}\0".encode())
+        h.update(data)
+    return h.hexdigest()
+
+# clean arch system with base-devel and an unprivileged build user, since makepkg refuses to run as root.
+# it is created once and kept in the efly cache. update_build_root() upgrades it at the start of each build.
+def get_build_root():
+    root = elib.get_cache_dir() / "build-root"
+    if (root / "var" / "lib" / "pacman" / "local").is_dir():
+        return root
+
+    info(f"creating build root for PKGBUILDs: {root}")
+    staging = root.with_name("build-root.new")
+    sudo(["rm", "--recursive", "--force", staging])
+    sudo(["mkdir", "--parents", staging])
+    packages = ["base", "base-devel"]
+    if elib.host_is_arch():
+        sudo(["pacstrap"] + elib.pacstrap_args() + ["-c", staging] + packages)
+    else:
+        bootstrap_dir = elib.get_bootstrap()
+        target = Path("/efly-build-root")
+        sudo(["mkdir", "--parents", bootstrap_dir / target.name])
+        sudo(["mount", "--bind", staging, bootstrap_dir / target.name])
+        try:
+            sudo(["systemd-nspawn", "-qD", bootstrap_dir, "pacstrap"] + elib.pacstrap_args(bootstrap_dir) + ["-c", target] + packages)
+        finally:
+            sudo(["umount", bootstrap_dir / target.name])
+            sudo(["rmdir", bootstrap_dir / target.name])
+
+    sudo(["systemd-nspawn", "-qD", staging, "pacman-key", "--init"])
+    sudo(["systemd-nspawn", "-qD", staging, "pacman-key", "--populate"])
+    sudo(["systemd-nspawn", "-qD", staging, "useradd", "--create-home", "builder"])
+    elib.sudo_write(staging / "etc" / "sudoers.d" / "builder", "builder ALL=(ALL) NOPASSWD: /usr/bin/pacman\n")
+    sudo(["chmod", "440", staging / "etc" / "sudoers.d" / "builder"])
+    sudo(["mv", staging, root])
+    return root
+
+# upgrade the build root to the current repositories. this happens once per build, before any container
+# runs on top of it, so that the toolchain_id() of the cache keys is the toolchain the packages are built with.
+def update_build_root(root):
+    pacman_args = ["--config", elib.pacman_conf_path(root)] if elib.custom_downloads() else []
+    sudo(["systemd-nspawn", "-qD", root, "pacman", "--sync", "--refresh", "--sysupgrade", "--noconfirm"] + pacman_args)
+
+# installed packages of the build root (name-version) and its makepkg.conf
+def toolchain_id(root):
+    packages = sorted(p.name for p in (root / "var" / "lib" / "pacman" / "local").iterdir() if p.is_dir())
+    return "\n".join(packages) + "\n" + (root / "etc" / "makepkg.conf").read_text(encoding="utf-8")
+
+# package files produced by a PKGBUILD, without debug packages of pkgnames it does not declare
+def package_files(folder, pkgbuild):
+    return sorted(f for f in Path(folder).glob("*.pkg.tar*")
+        if not f.name.endswith(".sig") and f.name.rsplit("-", 3)[0] in pkgbuild["pkgname"])
+
+# inside the container: install the packages built from other PKGBUILDs and let makepkg install the
+# remaining build dependencies. the build root is not upgraded here, see update_build_root().
+build_script = """
+set -e
+if compgen -G '/build/deps/*.pkg.tar*' >/dev/null; then
+    pacman --upgrade --noconfirm --asdeps /build/deps/*.pkg.tar*
+fi
+cp --recursive /build/pkgbuild /home/builder/build
+chown --recursive builder:builder /home/builder/build /build/out
+cd /home/builder/build
+sudo --user=builder PKGDEST=/build/out makepkg --syncdeps --noconfirm --noprogressbar
+"""
+
+def build(pkgbuild, build_root, work, deps, log):
+    upper, overlay_work, merged, out, deps_dir = [work / d for d in ["upper", "work", "merged", "out", "deps"]]
+    for d in [upper, overlay_work, merged, out, deps_dir]:
+        d.mkdir(parents=True)
+    for f in deps:
+        shutil.copy(f, deps_dir)
+
+    sudo(["mount", "--types", "overlay", "overlay", "--options",
+        f"lowerdir={build_root},upperdir={upper},workdir={overlay_work}", merged])
+    try:
+        # downloads go through the proxy, the custom config or the local repository, like the rest of the build
+        binds = ["--bind-ro", f"{pkgbuild['path']}:/build/pkgbuild", "--bind-ro", f"{deps_dir}:/build/deps", "--bind", f"{out}:/build/out"]
+        if elib.local_repo:
+            binds += ["--bind-ro", f"{elib.local_repo}:{elib.local_repo_mount}"]
+            elib.sudo_write(merged / "etc" / "pacman.conf", elib.local_repo_conf(elib.local_repo_mount))
+        elif elib.custom_downloads():
+            elib.sudo_write(merged / "etc" / "pacman.conf", elib.build_conf(merged))
+        with open(log, "w") as handle:
+            returncode = sudo(["systemd-nspawn", "--quiet", "--register=no", "-D", merged] + binds + ["/bin/bash", "-c", build_script],
+                ignore_error=True, stdout=handle, stderr=subprocess.STDOUT)
+    finally:
+        sudo(["umount", merged])
+
+    # the packages belong to the build user of the container
+    sudo(["chown", "--recursive", f"{os.getuid()}:{os.getgid()}", out])
+    files = package_files(out, pkgbuild)
+    if returncode != 0 or not files:
+        raise RuntimeError(f"building {pkgbuild['name']} failed. see {log}")
+    return files
+
+# build all PKGBUILDs of a profile that are not cached yet. returns the package files to install.
+def build_all(profile, jobs):
+    pkgbuilds = build_order(read_profile(profile))
+    if not pkgbuilds:
+        return []
+
+    cache = elib.get_cache_dir() / "pkgbuilds"
+    cache.mkdir(parents=True, exist_ok=True)
+    build_root = get_build_root()
+    update_build_root(build_root)
+    toolchain = toolchain_id(build_root)
+    keys = {}
+    for pkgbuild in pkgbuilds:
+        keys[pkgbuild["name"]] = pkgbuild_hash(pkgbuild, toolchain, [keys[d] for d in local_deps(pkgbuild, pkgbuilds)])
+    cached = lambda p: package_files(cache / keys[p["name"]], p)
+    missing = [p for p in pkgbuilds if not cached(p)]
+    info(f"PKGBUILDs: {len(pkgbuilds) - len(missing)} cached, {len(missing)} to build")
+    for pkgbuild in pkgbuilds:
+        elib.count_cache("pkgbuilds", pkgbuild not in missing)
+
+    # submit a build as soon as the builds it depends on are done. the containers are kept in the cache
+    # folder as well, since /tmp is often too small for building.
+    def run(pkgbuild):
+        name = pkgbuild["name"]
+        work = cache / f"{name}.work"
+        sudo(["rm", "--recursive", "--force", work])
+        log = cache / f"{name}-{keys[name][:12]}.log"
+        deps = [f for d in local_deps(pkgbuild, pkgbuilds) for f in cached(next(p for p in pkgbuilds if p["name"] == d))]
+        info(f"building {name} (log: {log})")
+        try:
+            files = build(pkgbuild, build_root, work, deps, log)
+            # move the packages into the cache at once, so that an interrupted build caches nothing
+            staging = cache / f"{keys[name]}.new"
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir()
+            for f in files:
+                shutil.move(f, staging / f.name)
+            os.rename(staging, cache / keys[name])
+            info(f"built {name}: {' '.join(f.name for f in files)}")
+        finally:
+            sudo(["rm", "--recursive", "--force", work])
+
+    done = {p["name"] for p in pkgbuilds if p not in missing}
+    pending = list(missing)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+        while pending or running:
+            for pkgbuild in [p for p in pending if all(d in done for d in local_deps(p, pkgbuilds))]:
+                pending.remove(pkgbuild)
+                running[pool.submit(run, pkgbuild)] = pkgbuild["name"]
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                done.add(running.pop(future))
+
+    return [f for p in pkgbuilds for f in cached(p)]
+
+# install built packages into the image. their runtime dependencies come from the repositories.
+def install(chroot_fs, files):
+    target = Path("/var/cache/efly-pkgbuilds")
+    sudo(["mkdir", "--parents", chroot_fs / target.relative_to("/")])
+    sudo(["cp"] + files + [chroot_fs / target.relative_to("/")])
+    pacman_args = ["--config", elib.pacman_conf_path(chroot_fs)] if elib.local_repo or elib.pacman_conf else []
+    chroot(chroot_fs, ["pacman", "--upgrade", "--needed", "--noconfirm"] + pacman_args + [target / f.name for f in files])
+    sudo(["rm", "--recursive", chroot_fs / target.relative_to("/")])
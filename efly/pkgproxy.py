@@ -0,0 +1,322 @@
+# local caching http proxy for pacman. efly-dd runs it during a build and points the mirrorlist of the
+# bootstrap system and of the target system to it. repo databases and packages are served from a
+# persistent cache. misses are fetched from the fastest mirrors and large packages are striped across
+# several mirrors using http range requests.
+#
+# repo databases are fetched once per proxy, i.e. once per build, and pinned in a snapshot folder. every
+# pacman of the build sees the same databases and thus the same package versions, even if the mirrors
+# or another build update the cache meanwhile. requests with If-Modified-Since are answered with
+# "304 Not Modified", so a pacman that already has the snapshot does not download it again.
+
+import email.utils, os, re, shutil, threading, tempfile, time, urllib.parse, urllib.request, urllib.error, http.client
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+# files larger than this are downloaded in parallel segments from several mirrors
+stripe_threshold = 16 * 1024 * 1024
+stripe_segment_size = 4 * 1024 * 1024
+stripe_mirrors = 4
+timeout = 10
+chunk_size = 64 * 1024
+
+# repo databases change on the mirrors. all other files (packages and their signatures) never change
+# for a given file name and can be kept in the cache forever.
+db_regex = re.compile(r'\.(db|files)(\.tar\.\w+)?(\.sig)?$')
+pkg_regex = re.compile(r'\.pkg\.tar(\.\w+)?$')
+
+# parse "Server = ..." lines of a mirrorlist and return the mirror base urls, in order of appearance.
+# e.g. "Server = https://example.org/archlinux/$repo/os/$arch" becomes "https://example.org/archlinux/"
+def parse_mirrorlist(mirrorlist):
+    mirrors = []
+    for line in mirrorlist.splitlines():
+        line = line.split('#')[0].strip()
+        key, _, value = line.partition('=')
+        if key.strip() != "Server":
+            continue
+        url = value.strip()
+        url = url[:url.index("$repo")] if "$repo" in url else url.rstrip('/') + '/'
+        if url not in mirrors:
+            mirrors.append(url)
+    return mirrors
+
+class FetchError(Exception):
+    pass
+
+class PackageProxy:
+    def __init__(self, cache_dir, mirrors, host="127.0.0.1", port=0):
+        if not mirrors:
+            raise ValueError("package proxy needs at least one mirror")
+        self.cache_dir = Path(cache_dir)
+        self.mirrors = list(mirrors)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # a lock and the number of requests using it, per path being fetched. concurrent requests for the
+        # same file wait for the first one. the entry is removed when the last request is done.
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+        # databases fetched during the lifetime of this proxy, hard linked into the snapshot folder
+        self.snapshot_dir = Path(tempfile.mkdtemp(dir=self.cache_dir, prefix=".db-snapshot-"))
+        self.snapshot = {}
+
+        # hits and misses of repo databases ("db") and packages ("pkg"). per mirror and kind, the downloaded
+        # bytes and the time spent downloading them.
+        self.stats_lock = threading.Lock()
+        self.stats = {"db": {"hits": 0, "misses": 0}, "pkg": {"hits": 0, "misses": 0}, "bytes_served": 0, "mirrors": {}}
+
+        proxy = self
+        class Handler(ProxyRequestHandler):
+            pass
+        Handler.proxy = proxy
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    # mirrorlist that directs pacman to this proxy
+    def mirrorlist(self):
+        return f"# pacman cache proxy of efly. this file is replaced after the build.\nServer = {self.url}$repo/os/$arch\n"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="efly-pkgproxy", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+    def count(self, key, value=1, kind=None):
+        with self.stats_lock:
+            stats = self.stats[kind] if kind else self.stats
+            stats[key] += value
+
+    def count_download(self, mirror, path, size, seconds):
+        if not size:
+            return
+        kind = "db" if db_regex.search(path) else "pkg"
+        with self.stats_lock:
+            stats = self.stats["mirrors"].setdefault(mirror, {}).setdefault(kind, {"bytes": 0, "seconds": 0.0})
+            stats["bytes"] += size
+            stats["seconds"] += seconds
+
+    # return the cache path for the given request path. returns None for paths we do not serve.
+    def cache_path(self, path):
+        path = urllib.parse.unquote(path.split('?')[0]).lstrip('/')
+        parts = path.split('/')
+        if not path or any(p in ("", ".", "..") for p in parts):
+            return None
+        return self.cache_dir.joinpath(*parts)
+
+    # make sure the file for the given request path is in the cache and return its cache path
+    def get(self, path):
+        dest = self.cache_path(path)
+        if dest is None:
+            raise FetchError(f"invalid path: {path}")
+        is_db = bool(db_regex.search(dest.name))
+        kind = "db" if is_db else "pkg"
+
+        with self.inflight_lock:
+            entry = self.inflight.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                if is_db and path in self.snapshot:
+                    self.count("hits", kind=kind)
+                    return self.snapshot[path]
+                if dest.is_file() and not is_db:
+                    self.count("hits", kind=kind)
+                    return dest
+
+                self.count("misses", kind=kind)
+                try:
+                    self.fetch(path, dest)
+                except FetchError:
+                    # a stale database is better than none. pacman checks its signature anyway.
+                    if not (is_db and dest.is_file()):
+                        raise
+                if is_db:
+                    return self.pin(path, dest)
+                return dest
+        finally:
+            with self.inflight_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.inflight[path]
+
+    # keep the database of this build in the snapshot folder. the cache file may be replaced later on.
+    def pin(self, path, dest):
+        pinned = self.snapshot_dir.joinpath(*dest.relative_to(self.cache_dir).parts)
+        pinned.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(dest, pinned)
+        except OSError:
+            shutil.copy2(dest, pinned)
+        self.snapshot[path] = pinned
+        return pinned
+
+    # download a file from the mirrors into the cache. try the mirrors in order, fastest first.
+    def fetch(self, path, dest):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                if not self.fetch_striped(path, file):
+                    self.fetch_single(path, file)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # obtain the file size from the fastest mirror that has the file
+    def head(self, path):
+        for mirror in self.mirrors[:stripe_mirrors]:
+            request = urllib.request.Request(mirror + path.lstrip('/'), method="HEAD")
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    return int(response.headers.get("Content-Length", 0)) or None
+            except (OSError, urllib.error.URLError, http.client.HTTPException, ValueError):
+                continue
+        return None
+
+    def fetch_single(self, path, file):
+        errors = []
+        for mirror in self.mirrors:
+            file.seek(0)
+            file.truncate()
+            start = time.monotonic()
+            try:
+                with urllib.request.urlopen(mirror + path.lstrip('/'), timeout=timeout) as response:
+                    while data := response.read(chunk_size):
+                        file.write(data)
+                return
+            except (OSError, urllib.error.URLError, http.client.HTTPException) as e:
+                errors.append(f"{mirror}: {e}")
+            finally:
+                # bytes of failed downloads count as well. they were transferred nevertheless.
+                self.count_download(mirror, path, file.tell(), time.monotonic() - start)
+        raise FetchError(f"could not fetch {path}: " + "; ".join(errors))
+
+    # download a large package in segments. segment i is requested from mirror i modulo the number of
+    # striping mirrors. a failed segment is retried on the other mirrors. returns False, if the file was
+    # not downloaded this way.
+    def fetch_striped(self, path, file):
+        if len(self.mirrors) < 2 or not pkg_regex.search(path):
+            return False
+        size = self.head(path)
+        if not size or size <= stripe_threshold:
+            return False
+
+        mirrors = self.mirrors[:stripe_mirrors]
+        segments = [(start, min(start + stripe_segment_size, size) - 1) for start in range(0, size, stripe_segment_size)]
+        file.truncate(size)
+        fd = file.fileno()
+
+        def fetch_segment(i):
+            start, end = segments[i]
+            order = mirrors[i % len(mirrors):] + mirrors[:i % len(mirrors)]
+            for mirror in order:
+                request = urllib.request.Request(mirror + path.lstrip('/'), headers={"Range": f"bytes={start}-{end}"})
+                offset = start
+                started = time.monotonic()
+                try:
+                    with urllib.request.urlopen(request, timeout=timeout) as response:
+                        if response.status != 206:
+                            continue
+                        while data := response.read(chunk_size):
+                            os.pwrite(fd, data, offset)
+                            offset += len(data)
+                        if offset == end + 1:
+                            return
+                except (OSError, urllib.error.URLError, http.client.HTTPException):
+                    continue
+                finally:
+                    self.count_download(mirror, path, offset - start, time.monotonic() - started)
+            raise FetchError(f"could not fetch bytes {start}-{end} of {path}")
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(mirrors)) as pool:
+                list(pool.map(fetch_segment, range(len(segments))))
+            return True
+        except FetchError:
+            return False # fall back to downloading the whole file from a single mirror
+
+class ProxyRequestHandler(BaseHTTPRequestHandler):
+    proxy = None
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        try:
+            path = self.proxy.get(self.path)
+        except FetchError:
+            self.send_error(404)
+            return
+
+        size = path.stat().st_size
+        start, end = 0, size - 1
+
+        # pacman sets the modification time of a downloaded database to our Last-Modified and sends it
+        # back on the next refresh. the snapshot has not changed since then.
+        try:
+            modified_since = email.utils.parsedate_to_datetime(self.headers.get("If-Modified-Since")).timestamp()
+        except (TypeError, ValueError):
+            modified_since = None
+        if modified_since is not None and int(path.stat().st_mtime) <= modified_since:
+            self.send_response(304)
+            self.send_header("Last-Modified", self.date_time_string(path.stat().st_mtime))
+            self.end_headers()
+            return
+
+        # pacman resumes interrupted downloads with "Range: bytes=<start>-"
+        range_header = self.headers.get("Range")
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header or "")
+        # a range that starts behind the end of the file or ends before its start can not be satisfied
+        satisfiable = match and int(match[1]) < size and (not match[2] or int(match[2]) >= int(match[1]))
+        if satisfiable:
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        elif match:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Last-Modified", self.date_time_string(path.stat().st_mtime))
+        self.end_headers()
+
+        if body:
+            with open(path, "rb") as file:
+                file.seek(start)
+                remaining = end + 1 - start
+                while remaining > 0:
+                    data = file.read(min(chunk_size, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+            self.proxy.count("bytes_served", end + 1 - start)
+
+    def log_message(self, format, *args):
+        pass # pacman already reports every download
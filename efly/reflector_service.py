@@ -0,0 +1,223 @@
+# service mode of "efly reflector". installed efly systems run this periodically from a systemd timer.
+# every run rates only a few mirrors and merges the results into a rating history. the mirror list is
+# replaced only if the history shows that a meaningfully faster list is available.
+
+import argparse, json, logging, os, subprocess, sys, tempfile, time
+from pathlib import Path
+import Reflector
+from pkgproxy import parse_mirrorlist
+
+default_mirrorlist = "/etc/pacman.d/mirrorlist"
+default_state = "/var/lib/efly/reflector.json"
+
+# the core database is small. rating with it costs little bandwidth, at the cost of some accuracy.
+# the moving average over many runs makes up for that.
+default_db_subpath = "core/os/x86_64/core.db"
+
+# weight of a new rating in the moving average of a mirror's download rate
+ewma_weight = 0.3
+
+# forget mirrors that were not rated for this long
+history_max_age = 30 * 24 * 60 * 60
+
+logger = Reflector.get_logger()
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog="efly reflector --service",
+        description="Re-rate pacman mirrors incrementally and update the mirror list when the ranking improves."
+    )
+    parser.add_argument("--mirrorlist", default=default_mirrorlist, help="Mirror list to maintain. Default: %(default)s")
+    parser.add_argument("--state", default=default_state, help="Rating history. Default: %(default)s")
+    parser.add_argument("-n", "--number", type=int, default=20, help="Number of mirrors in the mirror list. Default: %(default)s")
+    parser.add_argument("--rate", type=int, default=6, metavar="n", help="Number of mirrors to rate per run. Default: %(default)s")
+    parser.add_argument("-p", "--protocol", dest="protocols", action="append", metavar="<protocol>",
+        help="Only use mirrors with the given protocol. Default: https")
+    parser.add_argument("-c", "--country", dest="countries", action="append", metavar="<country name or code>",
+        help="Restrict mirrors to selected countries.")
+    parser.add_argument("-a", "--age", type=float, default=12, metavar="n",
+        help="Only use mirrors that have synchronized in the last n hours. Default: %(default)s")
+    parser.add_argument("--min-improvement", type=float, default=0.2, metavar="f",
+        help="Replace the mirror list only if the expected download rate improves by this fraction. Default: %(default)s")
+    parser.add_argument("--db-subpath", default=default_db_subpath,
+        help="File downloaded from each mirror for rating. Default: %(default)s")
+    parser.add_argument("--cache-timeout", type=int, default=6 * 60 * 60, metavar="n",
+        help="Cache timeout in seconds for the mirror status data. Default: %(default)s")
+    parser.add_argument("--force", action="store_true", help="Run even on battery power or on a metered connection.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the new mirror list instead of saving it.")
+    parser.add_argument("--verbose", action="store_true", help="Print the rating of each mirror.")
+    options = parser.parse_args(args)
+    options.protocols = list(Reflector.split_list_args(options.protocols)) or ["https"]
+    options.countries = list(Reflector.split_list_args(options.countries))
+    return options
+
+# check if the system runs on battery. systems without battery (or without power supply info) are on AC.
+def on_battery():
+    power_supplies = Path("/sys/class/power_supply")
+    if not power_supplies.is_dir():
+        return False
+    discharging = False
+    for supply in power_supplies.iterdir():
+        try:
+            kind = (supply / "type").read_text().strip()
+            if kind == "Mains" and (supply / "online").read_text().strip() == "1":
+                return False
+            if kind == "Battery" and (supply / "status").read_text().strip() == "Discharging":
+                discharging = True
+        except OSError:
+            continue
+    return discharging
+
+# ask NetworkManager whether the primary connection is metered. 1 is "yes" and 3 is "guess yes".
+# https://networkmanager.dev/docs/api/latest/nm-dbus-types.html#NMMetered
+def on_metered_connection():
+    try:
+        output = subprocess.check_output([
+            "busctl", "get-property", "org.freedesktop.NetworkManager", "/org/freedesktop/NetworkManager",
+            "org.freedesktop.NetworkManager", "Metered"], stderr=subprocess.DEVNULL, timeout=10).decode().split()
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return len(output) == 2 and output[1] in ("1", "3")
+
+def load_history(path):
+    try:
+        with open(path, encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+# write a file atomically: write a temporary file next to it, then rename it over the original.
+def atomic_write(path, text, mode=0o644):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handle, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(handle, "w", encoding="utf-8") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+# choose the mirrors to rate in this run. half of the budget goes to the mirrors of the current list
+# that were rated least recently. the rest explores candidates without a rating yet, best score first,
+# and then the remaining candidates that were rated least recently.
+def select_for_rating(candidates, current, history, budget):
+    by_url = {m["url"]: m for m in candidates}
+    last_rated = lambda url: history.get(url, {}).get("last_rated", 0)
+
+    selected = []
+    for url in sorted((u for u in current if u in by_url), key=last_rated)[:budget // 2]:
+        selected.append(by_url[url])
+
+    unrated = [m for m in candidates if m["url"] not in history and m not in selected]
+    unrated.sort(key=lambda m: m["score"] if m["score"] is not None else float("inf"))
+    rated = sorted((m for m in candidates if m["url"] in history and m not in selected), key=lambda m: last_rated(m["url"]))
+    for mirror in unrated + rated:
+        if len(selected) >= budget:
+            break
+        selected.append(mirror)
+    return selected
+
+# merge new download rates (bytes per second) into the history
+def update_history(history, rates, now):
+    for url, rate in rates.items():
+        entry = history.setdefault(url, {"rate": rate, "samples": 0, "failures": 0})
+        entry["rate"] = rate if entry["samples"] == 0 else (1 - ewma_weight) * entry["rate"] + ewma_weight * rate
+        entry["samples"] += 1
+        entry["failures"] = entry["failures"] + 1 if rate == 0 else 0
+        entry["last_rated"] = now
+    for url in [u for u, e in history.items() if now - e.get("last_rated", 0) > history_max_age]:
+        del history[url]
+
+# expected download rate of a mirror list. pacman uses the first servers and falls back to the next
+# ones on failure, so the first few entries dominate.
+def expected_rate(urls, history, depth=3):
+    rates = [history.get(url, {}).get("rate", 0) for url in urls[:depth]]
+    return sum(rates) / depth
+
+# rank the candidates by their average download rate. mirrors without a rating yet fill up the rest
+# of the list: those of the current list first, then by score. mirrors that failed repeatedly are left out.
+def rank(candidates, current, history, number):
+    rate = lambda m: history.get(m["url"], {}).get("rate", 0)
+    failing = lambda m: history.get(m["url"], {}).get("failures", 0) >= 2
+    rated = sorted((m for m in candidates if rate(m) > 0 and not failing(m)), key=rate, reverse=True)
+    position = {url: i for i, url in enumerate(current)}
+    unrated = [m for m in candidates if m["url"] not in history]
+    unrated.sort(key=lambda m: (position.get(m["url"], len(position)), m["score"] if m["score"] is not None else float("inf")))
+    return (rated + unrated)[:number]
+
+def main(args=None):
+    options = parse_args(args)
+    logging.basicConfig(format="{levelname}: {message}", style="{", level=logging.INFO if options.verbose else logging.WARNING)
+    log = lambda msg: print(f"[efly-reflector] {msg}", flush=True)
+
+    if not options.force:
+        if on_battery():
+            log("running on battery. deferring mirror rating.")
+            return 0
+        if on_metered_connection():
+            log("metered network connection. deferring mirror rating.")
+            return 0
+
+    mirrorstatus = Reflector.MirrorStatus(cache_timeout=options.cache_timeout)
+    try:
+        candidates = list(mirrorstatus.filter(
+            countries=options.countries,
+            protocols=options.protocols,
+            age=options.age,
+        ))
+    except Reflector.MirrorStatusError as err:
+        log(f"error: {err.msg}")
+        return 1
+    if not candidates:
+        log("no mirrors match the given criteria.")
+        return 1
+
+    try:
+        current = parse_mirrorlist(Path(options.mirrorlist).read_text(encoding="utf-8"))
+    except OSError:
+        current = []
+
+    history = load_history(options.state)
+    now = time.time()
+    selected = select_for_rating(candidates, current, history, options.rate)
+    log(f"rating {len(selected)} of {len(candidates)} mirror(s)")
+
+    rates = {}
+    for mirror in selected:
+        time_delta, rate = Reflector.rate_http(mirror["url"] + options.db_subpath)
+        logger.info("%s %.2f KiB/s %.2f s", mirror["url"], rate / 1024, time_delta)
+        rates[mirror["url"]] = rate
+    update_history(history, rates, now)
+    atomic_write(options.state, json.dumps(history, indent=2, sort_keys=True))
+
+    ranked = rank(candidates, current, history, options.number)
+    new = [m["url"] for m in ranked]
+    old_rate = expected_rate(current, history)
+    new_rate = expected_rate(new, history)
+    log(f"expected rate of current list: {old_rate / 1024:.0f} KiB/s, best list: {new_rate / 1024:.0f} KiB/s")
+
+    if not new or new[:3] == current[:3] or new_rate <= old_rate * (1 + options.min_improvement):
+        log("keeping current mirror list.")
+        return 0
+
+    mirrorlist = Reflector.format_mirrorlist(
+        {"last_check": mirrorstatus.get_obj()["last_check"], "urls": ranked},
+        mirrorstatus.ms_mtime,
+        command=["--service"] + (args if args is not None else sys.argv[2:]),
+    )
+    if options.dry_run:
+        print(mirrorlist)
+    else:
+        atomic_write(options.mirrorlist, mirrorlist)
+        log(f"updated {options.mirrorlist}")
+    return 0
@@ -0,0 +1,599 @@
+# helpers for efly-qemu, which is a shell script. run as "python3 vmlib.py <command> ...".
+#
+# bench:      boot an image headless several times and report how long the boot takes. milestones are
+#             detected on the serial console. the guest reports its systemd timings, if the image
+#             contains efly-bench-report.service (images created by "efly dd" do).
+# register:   add a vm to the registry of running vms and allocate its ssh port. prints the port.
+# unregister: remove a vm from the registry.
+# save-state: save the ram and device state of a running vm into its state folder and stop the vm.
+# kernel:     extract kernel, initramfs and microcode from the efi partition of an image for direct
+#             kernel boot. prints the cached files and the kernel command line.
+# layout:     rewrite the files of a boot trace in boot order on a mounted root filesystem and write
+#             the readahead list. run as root.
+
+import argparse, base64, fcntl, hashlib, json, os, re, shlex, shutil, socket, stat, statistics, struct, subprocess, sys, threading, time, uuid, zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+# milestones visible on the serial console, in boot order. the time of the first match is recorded.
+serial_milestones = [
+    ("bootloader", re.compile(rb"GNU GRUB|\[efly\] Loading Linux")),
+    ("kernel", re.compile(rb"Linux version \d")),
+    ("initramfs", re.compile(rb"Run /init as init process|:: running early hook")),
+]
+
+# milestones reported by the guest, as microseconds since the kernel started
+guest_milestones = [
+    ("userspace", lambda r: r["manager"].get("UserspaceTimestampMonotonic")),
+    ("multi-user.target", lambda r: r["units"].get("multi-user.target")),
+    ("graphical.target", lambda r: r["units"].get("graphical.target")),
+    ("lightdm", lambda r: r["units"].get("lightdm.service")),
+    ("boot-finished", lambda r: r["manager"].get("FinishTimestampMonotonic")),
+]
+
+grub_menu = re.compile(rb"GNU GRUB")
+report_regex = re.compile(rb"EFLY-BENCH-REPORT-BEGIN\s*(\{.*?\})\s*EFLY-BENCH-REPORT-END", re.DOTALL)
+trace_regex = re.compile(rb"EFLY-BOOT-TRACE-BEGIN\s*(.*?)EFLY-BOOT-TRACE-END", re.DOTALL)
+
+def log(msg):
+    print(f"[efly] {msg}", file=sys.stderr, flush=True)
+
+# boot once. qemu must be started with "-serial stdio". returns the milestones in seconds since the
+# start of qemu and the guest report.
+def bench_run(qemu_cmd, timeout, skip_grub_timeout=True, console_log=None):
+    start = time.monotonic()
+    process = subprocess.Popen(qemu_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+    milestones = {}
+    output = bytearray()
+    report = None
+    trace = None
+    grub_skipped = False
+
+    # kill qemu when the timeout is reached. reading the console below then ends as well.
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        while data := os.read(process.stdout.fileno(), 4096):
+            now = time.monotonic() - start
+            if console_log:
+                console_log.write(data)
+            # only search the new data plus some overlap for patterns spanning two reads
+            window = bytes(output[-256:]) + data
+            output += data
+
+            for name, regex in serial_milestones:
+                if name not in milestones and regex.search(window):
+                    milestones[name] = now
+
+            # skip the grub menu timeout by pressing enter on the serial console
+            if skip_grub_timeout and not grub_skipped and grub_menu.search(window):
+                process.stdin.write(b"\r")
+                process.stdin.flush()
+                grub_skipped = True
+
+            if report is None and b"EFLY-BENCH-REPORT-END" in window:
+                match = report_regex.search(output)
+                if match:
+                    report = json.loads(match[1])
+                    milestones["report"] = now
+
+            # file list of efly-boot-trace.service, see "efly qemu --boot-trace"
+            if trace is None and b"EFLY-BOOT-TRACE-END" in window:
+                match = trace_regex.search(output)
+                if match:
+                    trace = json.loads(zlib.decompress(base64.b64decode(match[1])))
+    finally:
+        timer.cancel()
+        returncode = process.wait()
+
+    # place the guest timestamps on our timeline. the kernel start is the closest reference we have.
+    if report and "kernel" in milestones:
+        for name, get in guest_milestones:
+            value = get(report)
+            if value:
+                milestones[name] = milestones["kernel"] + value / 1e6
+
+    return {
+        "returncode": returncode,
+        "timed_out": time.monotonic() - start >= timeout,
+        "grub_timeout_skipped": grub_skipped,
+        "milestones": dict(sorted(milestones.items(), key=lambda m: m[1])),
+        "guest": report,
+        "trace": trace,
+    }
+
+def summarize(runs):
+    summary = {}
+    names = dict.fromkeys(name for run in runs for name in run["milestones"])
+    for name in names:
+        values = [run["milestones"][name] for run in runs if name in run["milestones"]]
+        summary[name] = {
+            "runs": len(values),
+            "min": min(values),
+            "median": statistics.median(values),
+            "mean": statistics.mean(values),
+            "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+            "max": max(values),
+        }
+    return summary
+
+def bench(args):
+    parser = argparse.ArgumentParser(prog="efly qemu --bench")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds until a boot is aborted.")
+    parser.add_argument("--output", help="Write the json report to this file instead of stdout.")
+    parser.add_argument("--console-log", help="Append the serial console output of all runs to this file.")
+    parser.add_argument("--keep-grub-timeout", action="store_true", help="Do not skip the grub menu timeout.")
+    parser.add_argument("--trace-output", help="Write the boot trace of the guest to this file.")
+    parser.add_argument("qemu", nargs=argparse.REMAINDER, help="qemu command line after \"--\"")
+    options = parser.parse_args(args)
+    qemu_cmd = options.qemu[1:] if options.qemu[:1] == ["--"] else options.qemu
+
+    console_log = open(options.console_log, "ab") if options.console_log else None
+    runs = []
+    for i in range(options.runs):
+        log(f"benchmark run {i + 1}/{options.runs}")
+        run = bench_run(qemu_cmd, options.timeout, not options.keep_grub_timeout, console_log)
+        trace = run.pop("trace")
+        runs.append(run)
+        if options.trace_output and trace:
+            Path(options.trace_output).write_text(json.dumps(trace, indent=2) + "\n")
+            log(f"boot trace of {len(trace)} files written to {options.trace_output}")
+        elif options.trace_output:
+            log("no boot trace from the guest. does the image contain efly-boot-trace.service?")
+        milestones = ", ".join(f"{k} {v:.2f}s" for k, v in run["milestones"].items())
+        log(f"run {i + 1}: {milestones or 'no milestones detected'}")
+        if not run["guest"]:
+            log("no boot report from the guest. does the image contain efly-bench-report.service?")
+    if console_log:
+        console_log.close()
+
+    result = {
+        "benchmark": "boot",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "qemu": qemu_cmd,
+        "runs": runs,
+        "summary": summarize(runs),
+    }
+    output = json.dumps(result, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + "\n")
+        log(f"boot benchmark written to {options.output}")
+    else:
+        print(output)
+    traced = not options.trace_output or Path(options.trace_output).is_file()
+    return 0 if all(run["guest"] for run in runs) and traced else 1
+
+# registry of running vms, shared by all "efly qemu" processes of the user. vms are keyed by the pid of
+# their efly-qemu process. entries of processes that no longer exist are dropped on every access.
+runtime_dir = Path(os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/efly-{os.getuid()}")
+registry_dir = runtime_dir / "efly" / "fleet"
+registry_file = registry_dir / "registry.json"
+
+ssh_port_range = range(60022, 61022)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# read the registry while holding its lock. changes to the returned dict are written back.
+@contextmanager
+def registry():
+    registry_dir.mkdir(parents=True, exist_ok=True)
+    with open(registry_dir / "registry.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            vms = json.loads(registry_file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            vms = {}
+        vms = {pid: vm for pid, vm in vms.items() if pid_alive(int(pid))}
+        yield vms
+        tmp = registry_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(vms, indent=2))
+        tmp.replace(registry_file)
+
+def list_vms():
+    with registry() as vms:
+        return sorted(vms.values(), key=lambda vm: vm["started"])
+
+# a port is free, if we can bind it. qemu binds it on all interfaces for the forward, so we do as well.
+def port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+# first port that is neither bound nor reserved by a registered vm, which may not have bound it yet
+def allocate_port(vms, ports=ssh_port_range):
+    reserved = {vm["ssh_port"] for vm in vms.values()}
+    for port in ports:
+        if port not in reserved and port_free(port):
+            return port
+    raise RuntimeError(f"no free tcp port in range {ports.start}-{ports.stop - 1}")
+
+def register(args):
+    parser = argparse.ArgumentParser(prog="vmlib.py register")
+    parser.add_argument("--pid", type=int, required=True, help="pid of the efly-qemu process")
+    parser.add_argument("--name", required=True)
+    parser.add_argument("--image", required=True)
+    parser.add_argument("--ssh-port", default="auto", help="port number or \"auto\"")
+    parser.add_argument("--qmp", help="path of the qmp socket")
+    parser.add_argument("--overlay", default="")
+    parser.add_argument("--state", default="", help="state folder, if the vm records a state")
+    options = parser.parse_args(args)
+
+    with registry() as vms:
+        names = {vm["name"] for pid, vm in vms.items() if int(pid) != options.pid}
+        if options.name in names:
+            print(f"[efly] error: a vm named \"{options.name}\" is already running", file=sys.stderr)
+            return 1
+        if options.ssh_port == "auto":
+            port = allocate_port(vms)
+        else:
+            port = int(options.ssh_port)
+            if not port_free(port) or port in {vm["ssh_port"] for vm in vms.values()}:
+                print(f"[efly] error: tcp port {port} is already in use", file=sys.stderr)
+                return 1
+        vms[str(options.pid)] = {
+            "name": options.name,
+            "pid": options.pid,
+            "image": str(Path(options.image).resolve()),
+            "overlay": options.overlay,
+            "ssh_port": port,
+            "qmp": options.qmp,
+            "state": options.state,
+            "started": time.time(),
+        }
+    print(port)
+    return 0
+
+def unregister(args):
+    parser = argparse.ArgumentParser(prog="vmlib.py unregister")
+    parser.add_argument("--pid", type=int, required=True)
+    options = parser.parse_args(args)
+    with registry() as vms:
+        vms.pop(str(options.pid), None)
+    return 0
+
+# send a command to the qmp socket of a vm and return the result
+def qmp(path, command, timeout=10, **arguments):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(str(path))
+        stream = s.makefile("rwb")
+
+        def call(execute, arguments=None):
+            request = {"execute": execute} | ({"arguments": arguments} if arguments else {})
+            stream.write(json.dumps(request).encode() + b"\n")
+            stream.flush()
+            while line := stream.readline():
+                response = json.loads(line)
+                if "error" in response:
+                    raise RuntimeError(f"qmp {execute}: {response['error'].get('desc')}")
+                if "return" in response:
+                    return response["return"]
+                # skip asynchronous events
+            raise ConnectionError("qmp socket closed")
+
+        stream.readline() # greeting
+        call("qmp_capabilities")
+        return call(command, arguments)
+
+# save the vm state via migration into a file. the vm is paused first, so that its disk overlay matches
+# the saved ram. the vm is stopped afterwards: continuing would change the disk behind the saved state.
+def save_state(qmp_path, state_dir, timeout=600):
+    state_dir = Path(state_dir)
+    target = state_dir / ("vmstate.zst" if shutil.which("zstd") else "vmstate")
+    tmp = target.with_name(target.name + ".tmp")
+    # the file appears under its final name only after the writer has finished
+    writer = "zstd --quiet -T0 -3 -o" if target.suffix == ".zst" else "cat >"
+    writer = f"{writer} {shlex.quote(str(tmp))} && mv {shlex.quote(str(tmp))} {shlex.quote(str(target))}"
+
+    start = time.monotonic()
+    qmp(qmp_path, "stop")
+    qmp(qmp_path, "migrate", uri=f"exec:{writer}")
+    while True:
+        status = qmp(qmp_path, "query-migrate")
+        if status.get("status") == "completed":
+            break
+        if status.get("status") in ("failed", "cancelled"):
+            raise RuntimeError(f"saving the vm state failed: {status.get('error-desc', status.get('status'))}")
+        if time.monotonic() - start > timeout:
+            qmp(qmp_path, "migrate_cancel")
+            raise RuntimeError(f"saving the vm state did not finish within {timeout}s")
+        time.sleep(0.1)
+
+    # the writer may still be compressing, after qemu reported completion
+    while not target.exists():
+        if time.monotonic() - start > timeout:
+            raise RuntimeError(f"the vm state was not written within {timeout}s")
+        time.sleep(0.05)
+    qmp(qmp_path, "quit")
+    log(f"vm state saved in {time.monotonic() - start:.1f}s: {target} ({target.stat().st_size // 2**20} MiB)")
+
+def save_state_command(args):
+    parser = argparse.ArgumentParser(prog="vmlib.py save-state")
+    parser.add_argument("--qmp", required=True)
+    parser.add_argument("--state", required=True, help="state folder of the vm")
+    options = parser.parse_args(args)
+    try:
+        save_state(options.qmp, options.state)
+    except (OSError, RuntimeError) as e:
+        log(f"error: {e}")
+        return 1
+    return 0
+
+# partition type guids
+esp_type = uuid.UUID("c12a7328-f81f-11d2-ba4b-00a0c93ec93b")
+linux_types = [
+    uuid.UUID("4f68bce3-e8cd-4db1-96e7-fbcaf984b709"), # linux root (x86-64)
+    uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4"), # linux filesystem data
+]
+
+kernel_cache_dir = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "efly" / "kernels"
+ucode_files = ["intel-ucode.img", "amd-ucode.img"]
+
+# read the partition table of a gpt disk image. offsets and sizes in bytes.
+def read_gpt(image, sector_size=512):
+    with open(image, "rb") as f:
+        f.seek(sector_size)
+        header = f.read(92)
+        if header[:8] != b"EFI PART":
+            raise RuntimeError(f"no gpt partition table found: {image}")
+        entries_lba, entry_count, entry_size = struct.unpack_from("<QII", header, 72)
+        f.seek(entries_lba * sector_size)
+        entries = f.read(entry_count * entry_size)
+
+    partitions = []
+    for i in range(entry_count):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        type_guid = uuid.UUID(bytes_le=entry[0:16])
+        if type_guid.int == 0:
+            continue
+        first_lba, last_lba = struct.unpack_from("<QQ", entry, 32)
+        partitions.append({
+            "number": i + 1,
+            "type": type_guid,
+            "partuuid": str(uuid.UUID(bytes_le=entry[16:32])),
+            "offset": first_lba * sector_size,
+            "size": (last_lba - first_lba + 1) * sector_size,
+            "name": entry[56:128].decode("utf-16-le").rstrip("\0"),
+        })
+    return partitions
+
+# the efi partition and the root partition. root is "efly-root", as created by efly dd, or the first
+# linux partition.
+def find_partitions(image):
+    partitions = read_gpt(image)
+    esp = next((p for p in partitions if p["type"] == esp_type), None)
+    root = next((p for p in partitions if p["name"] == "efly-root"), None) \
+        or next((p for p in partitions if p["type"] in linux_types), None)
+    if not esp or not root:
+        raise RuntimeError(f"efi or root partition not found in the partition table of {image}")
+    return esp, root
+
+# hash of the efi partition contents. hashing is skipped, if the image file did not change since the
+# last time (same device, inode, size and modification time).
+def esp_hash(image, esp):
+    st = os.stat(image)
+    file_key = f"{os.path.realpath(image)}:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{esp['offset']}"
+    index_file = kernel_cache_dir / "index.json"
+    try:
+        index = json.loads(index_file.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        index = {}
+    if file_key in index:
+        return index[file_key]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image, "rb") as f:
+        f.seek(esp["offset"])
+        remaining = esp["size"]
+        while remaining > 0:
+            chunk = f.read(min(remaining, 4 * 2**20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    index[file_key] = digest.hexdigest()
+    kernel_cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = index_file.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(index, indent=2))
+    tmp.replace(index_file)
+    return index[file_key]
+
+# copy a file out of the fat filesystem of the efi partition with mtools. returns False, if it does not exist.
+def esp_copy(image, esp, name, dest):
+    env = dict(os.environ, MTOOLS_SKIP_CHECK="1")
+    result = subprocess.run(["mcopy", "-n", "-i", f"{image}@@{esp['offset']}", f"::/{name}", str(dest)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+# extract kernel and initramfs (with the microcode images prepended) from the efi partition into the cache
+def extract_kernel(image, esp):
+    if not shutil.which("mcopy"):
+        raise RuntimeError("command \"mcopy\" not found. install mtools.")
+    cache = kernel_cache_dir / esp_hash(image, esp)
+    if (cache / "vmlinuz-linux").is_file():
+        return cache
+
+    tmp = Path(f"{cache}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    if not esp_copy(image, esp, "vmlinuz-linux", tmp / "vmlinuz-linux"):
+        shutil.rmtree(tmp)
+        raise RuntimeError(f"vmlinuz-linux not found on the efi partition of {image}")
+    # the kernel loads the microcode from the first cpio archive of the initrd, like grub passes them
+    with open(tmp / "initrd.img", "wb") as initrd:
+        for name in ucode_files + ["initramfs-linux.img"]:
+            if esp_copy(image, esp, name, tmp / name):
+                with open(tmp / name, "rb") as part:
+                    shutil.copyfileobj(part, initrd)
+                (tmp / name).unlink()
+    esp_copy(image, esp, "grub/grub.cfg", tmp / "grub.cfg")
+    try:
+        tmp.rename(cache)
+    except OSError: # extracted by another vm at the same time
+        shutil.rmtree(tmp)
+    return cache
+
+# kernel command line: root from the gpt, the remaining options from the grub config of the image
+def kernel_cmdline(cache, root):
+    options = []
+    grub_cfg = cache / "grub.cfg"
+    if grub_cfg.is_file():
+        match = re.search(r"^\s*linux\s+/vmlinuz-linux\s+(.*)$", grub_cfg.read_text(errors="replace"), re.MULTILINE)
+        if match:
+            options = [o for o in match[1].split() if not o.startswith(("root=", "console="))]
+    if "ro" not in options and "rw" not in options:
+        options.append("rw")
+    return " ".join([f"root=PARTUUID={root['partuuid']}"] + options + ["console=ttyS0,115200", "console=tty0"])
+
+def kernel(args):
+    parser = argparse.ArgumentParser(prog="vmlib.py kernel")
+    parser.add_argument("image")
+    options = parser.parse_args(args)
+    try:
+        esp, root = find_partitions(options.image)
+        cache = extract_kernel(options.image, esp)
+    except (OSError, RuntimeError) as e:
+        log(f"error: {e}")
+        return 1
+    print(f"kernel={cache / 'vmlinuz-linux'}")
+    print(f"initrd={cache / 'initrd.img'}")
+    print(f"append={kernel_cmdline(cache, root)}")
+    return 0
+
+# physical extents of a file as (offset, length) in bytes, via the FIEMAP ioctl of ext4, btrfs and f2fs.
+# for compressed (encoded) extents the length is the uncompressed one.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST, FIEMAP_EXTENT_UNKNOWN, FIEMAP_EXTENT_DATA_INLINE = 0x1, 0x2, 0x200
+fiemap_header = struct.Struct("QQIIII")
+fiemap_extent = struct.Struct("QQQ16xI12x")
+
+def file_extents(path, batch=256):
+    extents = []
+    start = 0
+    with open(path, "rb") as f:
+        while True:
+            buffer = bytearray(fiemap_header.pack(start, 2**64 - 1, FIEMAP_FLAG_SYNC, 0, batch, 0) + bytes(fiemap_extent.size * batch))
+            fcntl.ioctl(f, FS_IOC_FIEMAP, buffer)
+            mapped = fiemap_header.unpack_from(buffer)[3]
+            flags = FIEMAP_EXTENT_LAST
+            for i in range(mapped):
+                logical, physical, length, flags = fiemap_extent.unpack_from(buffer, fiemap_header.size + i * fiemap_extent.size)
+                if not flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DATA_INLINE):
+                    extents.append((physical, length))
+                start = logical + length
+            if mapped < batch or flags & FIEMAP_EXTENT_LAST:
+                return extents
+
+# how scattered the files are on disk, when read in the given order. a seek is a jump between two
+# extents by more than the gap, which also absorbs the uncertain length of compressed extents.
+def layout_stats(files, gap=128 * 1024):
+    stats = {"files": len(files), "extents": 0, "seeks": 0, "seek_distance": 0}
+    end = None
+    for path in files:
+        for physical, length in file_extents(path):
+            stats["extents"] += 1
+            if end is None or abs(physical - end) > gap:
+                stats["seeks"] += 1
+                stats["seek_distance"] += abs(physical - end) if end is not None else 0
+            end = physical + length
+    return stats
+
+# write a copy of the file into the staging folder and move it over the file. all copies are created in
+# the same folder, because ext4 places the data of a new file near the block group of its folder. so the
+# copies are allocated one after the other from free space, in boot order.
+def rewrite_file(path, staging, index):
+    st = os.lstat(path)
+    tmp = staging / str(index)
+    with open(path, "rb") as src, open(tmp, "xb") as dst:
+        while chunk := src.read(1024 * 1024):
+            dst.write(chunk)
+        # owner first, since chown clears the setuid bits. copystat copies the xattrs, e.g. file capabilities.
+        os.chown(tmp, st.st_uid, st.st_gid)
+        shutil.copystat(path, tmp)
+        # allocate the blocks now, in boot order, rather than in the order of the writeback
+        os.fsync(dst.fileno())
+    os.rename(tmp, path)
+
+# ext4 packs small files into preallocated chunks of the cpu and aligns the data of larger files. raising
+# both limits, as long as the rewrite runs, packs all copies one after the other. returns the old values.
+def ext4_pack_allocations(root_dev, values={"mb_stream_req": 1 << 30, "mb_group_prealloc": 32768}):
+    device = Path(os.path.realpath(f"/sys/dev/block/{os.major(root_dev)}:{os.minor(root_dev)}")).name
+    tunables = Path("/sys/fs/ext4") / device
+    if not tunables.is_dir():
+        return {}
+    old = {}
+    for name, value in values.items():
+        old[tunables / name] = (tunables / name).read_text().strip()
+        (tunables / name).write_text(str(value))
+    return old
+
+def layout(args):
+    parser = argparse.ArgumentParser(prog="vmlib.py layout")
+    parser.add_argument("root", help="mount point of the root filesystem of the image")
+    parser.add_argument("trace", help="boot trace written by \"efly qemu --boot-trace\"")
+    parser.add_argument("--max-size", type=int, default=64 * 1024 * 1024, help="Skip larger files. Default: 64MiB")
+    options = parser.parse_args(args)
+    root = Path(options.root)
+    root_dev = root.stat().st_dev
+
+    # files of the root filesystem only, with one name. renaming a copy over a hard link would split it.
+    files = []
+    for entry in sorted(json.loads(Path(options.trace).read_text()), key=lambda e: e["seconds"]):
+        if not entry["path"].startswith("/") or "\n" in entry["path"]:
+            continue
+        path = root / entry["path"].lstrip("/")
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_dev == root_dev and st.st_nlink == 1 and 0 < st.st_size <= options.max_size:
+            files.append(path)
+
+    before = layout_stats(files)
+    log(f"rewriting {len(files)} files in boot order")
+    # a staging folder left behind by an interrupted run only holds copies of files that were not moved
+    staging = root / ".efly-layout"
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+    tunables = ext4_pack_allocations(root_dev)
+    try:
+        for index, path in enumerate(files):
+            rewrite_file(path, staging, index)
+    finally:
+        for tunable, value in tunables.items():
+            tunable.write_text(value)
+        shutil.rmtree(staging)
+    after = layout_stats(files)
+
+    readahead_list = root / "var" / "lib" / "efly" / "readahead.list"
+    readahead_list.parent.mkdir(parents=True, exist_ok=True)
+    readahead_list.write_text("".join(f"/{path.relative_to(root)}\n" for path in files))
+    print(json.dumps({"bytes": sum(path.stat().st_size for path in files), "before": before, "after": after}))
+    return 0
+
+commands = {
+    "bench": bench,
+    "register": register,
+    "unregister": unregister,
+    "save-state": save_state_command,
+    "kernel": kernel,
+    "layout": layout,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(f"usage: vmlib.py <{'|'.join(commands)}> ...", file=sys.stderr)
+        sys.exit(2)
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))